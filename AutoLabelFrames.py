@@ -0,0 +1,140 @@
+import argparse
+import collections
+import glob
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+from tqdm import tqdm
+from yolov8 import YOLOv8
+
+MODEL_PATH = ".\\models\\tool_tip_v4.onnx"
+# Frames written by VideoToFrames.py / VideoUtils.getFrameFromVideo
+IMAGE_DIR = "E:\\Videos\\raw_frames\\"
+CLASS_NAMES = ["tool_tip"]
+CONF_THRESHOLD = 0.2
+IOU_THRESHOLD = 0.5
+
+IMAGE_TYPES = ("*.jpg", "*.jpeg", "*.png")
+BATCH_SIZE = 8
+# cv2.imread releases the GIL, so decode threads run next to inference
+DECODE_THREADS = 4
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-labels a directory of frames with the YOLOv8 detector. "
+                                                 "Writes a YOLO .txt label next to every image and skips images "
+                                                 "that already have one, so an interrupted run can be restarted.")
+    parser.add_argument("--model", help="ONNX model path", default=MODEL_PATH)
+    parser.add_argument("--image-dir", help="frames to label", default=IMAGE_DIR)
+    parser.add_argument("--conf", type=float, help="confidence threshold", default=CONF_THRESHOLD)
+    parser.add_argument("--iou", type=float, help="NMS IoU threshold", default=IOU_THRESHOLD)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                        help="images per session run, fixed-batch models use their own")
+    parser.add_argument("--decode-threads", type=int, default=DECODE_THREADS, help="threads decoding images")
+    parser.add_argument("--overwrite", action="store_true", help="relabel images that already have a label")
+    args = parser.parse_args()
+
+    image_paths = getListOfImages(args.image_dir)
+    if not args.overwrite:
+        image_paths = [path for path in image_paths if not os.path.isfile(getLabelPath(path))]
+    print(f"Labeling {len(image_paths)} images")
+
+    detector = YOLOv8(args.model, CLASS_NAMES, conf_thres=args.conf, iou_thres=args.iou)
+    num_images, elapsed = labelImages(detector, image_paths, args.batch_size, args.decode_threads)
+    print(f"Labeled {num_images} images at {num_images / elapsed if elapsed > 0 else 0.0:.1f} images/s")
+
+def getListOfImages(_dir):
+    """Returns the sorted list of images in _dir"""
+    image_list = []
+    for files in IMAGE_TYPES:
+        image_list.extend(glob.glob(os.path.join(_dir, files)))
+    return sorted(image_list)
+
+def getLabelPath(_imagePath):
+    return os.path.splitext(_imagePath)[0] + ".txt"
+
+def labelImages(_detector, _imagePaths, _batchSize=BATCH_SIZE, _decodeThreads=DECODE_THREADS):
+    """
+    Runs _detector over _imagePaths in batches and writes their labels
+        @return number of images labeled, seconds taken
+    """
+    start = time.perf_counter()
+    num_images = 0
+    with tqdm(total=len(_imagePaths), unit="img", desc="Labeling") as progress:
+        for paths, images in readBatches(_imagePaths, _batchSize, _decodeThreads):
+            for path, (boxes, scores, class_ids), image in zip(paths, detectBatch(_detector, images, _batchSize),
+                                                               images):
+                writeLabels(getLabelPath(path), boxes, class_ids, image.shape[:2])
+            num_images += len(paths)
+            progress.update(len(paths))
+    return num_images, time.perf_counter() - start
+
+def readBatches(_imagePaths, _batchSize, _numThreads):
+    """
+    Groups the decoded images into batches. Images that fail to decode are reported
+    and left out.
+        @return generator of (paths, images) lists of up to _batchSize images
+    """
+    paths, images = [], []
+    for path, image in readImages(_imagePaths, _numThreads, 2 * _batchSize):
+        if image is None:
+            print("Failed to read ", path)
+            continue
+        paths.append(path)
+        images.append(image)
+        if len(paths) == _batchSize:
+            yield paths, images
+            paths, images = [], []
+    if paths:
+        yield paths, images
+
+def readImages(_imagePaths, _numThreads, _readAhead):
+    """
+    Decodes _imagePaths on a thread pool, at most _readAhead images ahead of the caller
+        @return generator of (path, image) in the order of _imagePaths
+    """
+    with ThreadPoolExecutor(_numThreads) as executor:
+        pending = collections.deque()
+        for path in _imagePaths:
+            pending.append((path, executor.submit(cv2.imread, path)))
+            if len(pending) > _readAhead:
+                path, image = pending.popleft()
+                yield path, image.result()
+        while pending:
+            path, image = pending.popleft()
+            yield path, image.result()
+
+def detectBatch(_detector, _images, _batchSize):
+    """
+    detect_batch that also takes images of different sizes with models that preprocess
+    in the graph, those batch only frames of one size
+    """
+    if not _detector.raw_input or all(image.shape == _images[0].shape for image in _images):
+        return _detector.detect_batch(_images, _batchSize)
+    return [_detector.detect_batch([image], 1)[0] for image in _images]
+
+def writeLabels(_labelPath, _boxes, _classIds, _imageShape):
+    """
+    Writes one 'class x_center y_center width height' line per box, normalized to the
+    image size as AugmentImages.yoloToCv reads them. Images without detections get an
+    empty file, so reruns skip them. The file is written under a temporary name and
+    renamed, an interrupted run never leaves a partial label behind.
+    """
+    img_height, img_width = _imageShape
+    lines = []
+    for (x1, y1, x2, y2), class_id in zip(np.asarray(_boxes, dtype=np.float64), _classIds):
+        x1, x2 = np.clip([x1, x2], 0, img_width)
+        y1, y2 = np.clip([y1, y2], 0, img_height)
+        if x2 <= x1 or y2 <= y1:
+            continue
+        lines.append(f"{int(class_id)} {(x1 + x2) / 2 / img_width:.6f} {(y1 + y2) / 2 / img_height:.6f} "
+                     f"{(x2 - x1) / img_width:.6f} {(y2 - y1) / img_height:.6f}\n")
+
+    temp_path = _labelPath + ".tmp"
+    with open(temp_path, "w") as f:
+        f.writelines(lines)
+    os.replace(temp_path, _labelPath)
+
+if __name__ == "__main__":
+    main()
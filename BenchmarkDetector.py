@@ -0,0 +1,175 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import time
+import cv2
+import numpy as np
+import onnxruntime
+from yolov8 import YOLOv8
+from BenchmarkNMS import makeClutteredCandidates
+
+MODEL_PATH = os.path.join("models", "tool_tip_v4.onnx")
+CLASS_NAMES = ["tool_tip"]
+CONF_THRESHOLD = 0.2
+IOU_THRESHOLD = 0.5
+
+MONO_SIZE = (1080, 1920)
+STEREO_SIZE = (1080, 3840)
+NUM_CANDIDATES = [50, 500, 2000]
+NUM_DRAWN_BOXES = [5, 50]
+
+REPEATS = 50
+WARMUP = 5
+SEED = 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Times each step of the detection hot path on synthetic inputs "
+                                                 "and writes the results as JSON to compare commits.")
+    parser.add_argument("--model", help="ONNX model to benchmark", default=MODEL_PATH)
+    parser.add_argument("--output", help="JSON file to write, defaults to printing the JSON")
+    parser.add_argument("--compare", help="earlier results JSON to print the speedup against")
+    parser.add_argument("--repeats", type=int, help="timed runs per case", default=REPEATS)
+    parser.add_argument("--warmup", type=int, help="untimed runs per case", default=WARMUP)
+    args = parser.parse_args()
+
+    results = runBenchmarks(args.model, args.repeats, args.warmup)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+        print("Saved results to ", args.output)
+    else:
+        print(json.dumps(results, indent=4))
+
+    if args.compare:
+        with open(args.compare) as f:
+            printComparison(json.load(f), results)
+
+def runBenchmarks(_modelPath, _repeats=REPEATS, _warmup=WARMUP):
+    """
+    Times prepare_input, session.run, process_output, Utils.multiclass_nms and
+    Utils.draw_detections separately. Every input is generated from SEED, so runs
+    on different commits see the same data.
+
+        @return dict with the environment and one entry per case
+    """
+    detector = YOLOv8(_modelPath, CLASS_NAMES, conf_thres=CONF_THRESHOLD, iou_thres=IOU_THRESHOLD)
+    mono_frame = makeFrame(MONO_SIZE)
+    stereo_frame = makeFrame(STEREO_SIZE)
+    left_eye, right_eye = stereo_frame[:, :STEREO_SIZE[1] // 2], stereo_frame[:, STEREO_SIZE[1] // 2:]
+    cases = {}
+
+    def add(_name, _function, **_params):
+        cases[_name] = dict(_params, **measure(_function, _repeats, _warmup))
+        print(f"{_name:<40} {cases[_name]['median_ms']:>10.3f} ms", flush=True)
+
+    add("prepare_input/mono_1080p", lambda: detector.prepare_input(mono_frame), shape=list(MONO_SIZE))
+    add("prepare_input/stereo_eye", lambda: detector.prepare_input(left_eye), shape=list(left_eye.shape[:2]))
+    add("prepare_input/stereo_full_frame", lambda: detector.prepare_input(stereo_frame), shape=list(STEREO_SIZE))
+
+    feeds = {detector.input_names[0]: detector.prepare_input(mono_frame).copy(), **detector.threshold_inputs}
+    add("session_run/batch_1", lambda: detector.session.run(detector.output_names, feeds), batch=1)
+    # Both eyes as one batch, fixed-batch models get the batch they were exported with
+    eyes = [left_eye, right_eye][:detector.input_batch_size or 2]
+    stereo_batch = detector.prepare_batch(eyes).copy()
+    feeds_stereo = {detector.input_names[0]: stereo_batch, **detector.threshold_inputs}
+    add("session_run/stereo_batch", lambda: detector.session.run(detector.output_names, feeds_stereo),
+        batch=len(stereo_batch))
+
+    real_output = detector.inference(detector.prepare_input(mono_frame))
+    real_output = [output.copy() for output in real_output]
+    add("process_output/model_output", lambda: detector.process_output(real_output, MONO_SIZE))
+    # Synthetic candidate sets only fit the raw (4 + C, A) output, not the NMS head
+    if not detector.embedded_nms:
+        for num_candidates in NUM_CANDIDATES:
+            output = makeClutteredOutput(detector, num_candidates)
+            add(f"process_output/cluttered_{num_candidates}", lambda: detector.process_output(output, MONO_SIZE),
+                candidates=num_candidates)
+
+    for num_candidates in NUM_CANDIDATES:
+        boxes, scores, class_ids = makeClutteredCandidates(num_candidates, len(CLASS_NAMES), MONO_SIZE, SEED)
+        add(f"multiclass_nms/loop_{num_candidates}",
+            lambda: detector.utils.multiclass_nms(boxes, scores, class_ids, IOU_THRESHOLD), candidates=num_candidates)
+        add(f"multiclass_nms/vectorized_{num_candidates}",
+            lambda: detector.utils.vectorized_multiclass_nms(boxes, scores, class_ids, IOU_THRESHOLD),
+            candidates=num_candidates)
+
+    for num_boxes in NUM_DRAWN_BOXES:
+        boxes, scores, class_ids = makeClutteredCandidates(num_boxes, len(CLASS_NAMES), MONO_SIZE, SEED)
+        add(f"draw_detections/mono_1080p_{num_boxes}",
+            lambda: detector.utils.draw_detections(mono_frame, boxes, scores, class_ids, 0.3), boxes=num_boxes)
+        # Into a reused buffer, the way a caller owning its output frame draws
+        output_frame = np.empty_like(mono_frame)
+        add(f"draw_detections/mono_1080p_{num_boxes}_out",
+            lambda: detector.utils.draw_detections(mono_frame, boxes, scores, class_ids, 0.3, out=output_frame),
+            boxes=num_boxes)
+
+    return {'environment': getEnvironment(_modelPath), 'repeats': _repeats, 'warmup': _warmup, 'cases': cases}
+
+def measure(_function, _repeats, _warmup):
+    """Runs _function _warmup times untimed, then returns stats of _repeats timed runs in ms"""
+    for _ in range(_warmup):
+        _function()
+    times = []
+    for _ in range(_repeats):
+        start = time.perf_counter()
+        _function()
+        times.append((time.perf_counter() - start) * 1000)
+    times = np.array(times)
+    return {'median_ms': float(np.median(times)), 'mean_ms': float(times.mean()),
+            'p95_ms': float(np.percentile(times, 95)), 'min_ms': float(times.min())}
+
+def makeFrame(_size, _seed=SEED):
+    """Deterministic frame with smooth texture, closer to video than plain noise"""
+    rng = np.random.default_rng(_seed)
+    img_height, img_width = _size
+    small = rng.integers(0, 256, size=(img_height // 16, img_width // 16, 3), dtype=np.uint8)
+    return cv2.resize(small, (img_width, img_height), interpolation=cv2.INTER_CUBIC)
+
+def makeClutteredOutput(_detector, _numCandidates):
+    """
+    Raw (1, 4 + C, A) model output whose first _numCandidates anchors hold a cluttered
+    candidate set above the confidence threshold, with boxes in model input coordinates
+    """
+    num_classes = len(CLASS_NAMES)
+    boxes, scores, class_ids = makeClutteredCandidates(_numCandidates, num_classes,
+                                                       (_detector.input_height, _detector.input_width), SEED)
+    num_anchors = max(_numCandidates, (_detector.input_height // 8) * (_detector.input_width // 8) +
+                      (_detector.input_height // 16) * (_detector.input_width // 16) +
+                      (_detector.input_height // 32) * (_detector.input_width // 32))
+    output = np.zeros((1, 4 + num_classes, num_anchors), dtype=np.float32)
+    output[0, 0:2, :_numCandidates] = ((boxes[:, :2] + boxes[:, 2:]) / 2).T
+    output[0, 2:4, :_numCandidates] = (boxes[:, 2:] - boxes[:, :2]).T
+    output[0, 4 + class_ids, np.arange(_numCandidates)] = scores
+    return [output]
+
+def getEnvironment(_modelPath):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'model': _modelPath,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'onnxruntime': onnxruntime.__version__,
+        'processor': platform.processor() or platform.machine(),
+        'cpu_count': os.cpu_count(),
+    }
+
+def printComparison(_before, _after):
+    """Prints the median speedup of every case in both result sets"""
+    print(f"{'case':<40} {'before ms':>10} {'after ms':>10} {'speedup':>8}")
+    for name, case in _after['cases'].items():
+        if name not in _before['cases']:
+            continue
+        before_ms = _before['cases'][name]['median_ms']
+        after_ms = case['median_ms']
+        print(f"{name:<40} {before_ms:>10.3f} {after_ms:>10.3f} {before_ms / after_ms:>7.2f}x")
+
+if __name__ == "__main__":
+    main()
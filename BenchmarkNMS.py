@@ -0,0 +1,75 @@
+import argparse
+import time
+import numpy as np
+from yolov8.utils import Utils
+
+NUM_CANDIDATES = [50, 200, 500, 1000, 2000, 5000]
+NUM_CLASSES = 1
+IOU_THRESHOLD = 0.5
+REPEATS = 20
+
+def makeClutteredCandidates(_numCandidates, _numClasses, _imageSize=(1080, 1920), _seed=0):
+    """
+    Makes a candidate set like the one left after confidence filtering on a cluttered
+    frame: groups of jittered boxes around a few objects plus scattered background boxes.
+        @param _numCandidates: number of candidate boxes
+        @param _numClasses: number of classes to spread the candidates over
+        @param _imageSize: (height, width) of the frame
+
+        @return boxes (xyxy), scores, class_ids
+    """
+    rng = np.random.default_rng(_seed)
+    img_height, img_width = _imageSize
+
+    # Most candidates cluster around objects, the rest are background noise
+    num_objects = max(1, _numCandidates // 25)
+    centers = rng.uniform([0, 0], [img_width, img_height], size=(num_objects, 2))
+    sizes = rng.uniform(30, 250, size=(num_objects, 2))
+    object_ids = rng.integers(0, num_objects, size=_numCandidates)
+    jitter = rng.normal(0, 0.15, size=(_numCandidates, 4))
+
+    xy = centers[object_ids] + jitter[:, :2] * sizes[object_ids]
+    wh = sizes[object_ids] * np.exp(jitter[:, 2:])
+    background = rng.random(_numCandidates) < 0.2
+    xy[background] = rng.uniform([0, 0], [img_width, img_height], size=(background.sum(), 2))
+
+    boxes = np.concatenate([xy - wh / 2, xy + wh / 2], axis=1).astype(np.float32)
+    scores = rng.uniform(0.2, 1.0, size=_numCandidates).astype(np.float32)
+    class_ids = rng.integers(0, _numClasses, size=_numCandidates)
+    return boxes, scores, class_ids
+
+def timeFunction(_function, _repeats):
+    """Returns the median run time of _function in milliseconds"""
+    times = []
+    for _ in range(_repeats):
+        start = time.perf_counter()
+        _function()
+        times.append((time.perf_counter() - start) * 1000)
+    return float(np.median(times))
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares the looped and vectorized multiclass NMS")
+    parser.add_argument("--classes", type=int, help="number of classes", default=NUM_CLASSES)
+    parser.add_argument("--iou", type=float, help="IoU threshold", default=IOU_THRESHOLD)
+    parser.add_argument("--repeats", type=int, help="timed runs per case", default=REPEATS)
+    args = parser.parse_args()
+
+    utils = Utils([str(i) for i in range(args.classes)])
+
+    print(f"{'candidates':>10} {'kept':>6} {'loop ms':>10} {'vector ms':>10} {'speedup':>8}")
+    for num_candidates in NUM_CANDIDATES:
+        boxes, scores, class_ids = makeClutteredCandidates(num_candidates, args.classes)
+
+        loop_keep = utils.multiclass_nms(boxes, scores, class_ids, args.iou)
+        vector_keep = utils.vectorized_multiclass_nms(boxes, scores, class_ids, args.iou)
+        if not np.array_equal(np.asarray(loop_keep), vector_keep):
+            raise RuntimeError(f"Keep sets differ for {num_candidates} candidates")
+
+        loop_ms = timeFunction(lambda: utils.multiclass_nms(boxes, scores, class_ids, args.iou), args.repeats)
+        vector_ms = timeFunction(lambda: utils.vectorized_multiclass_nms(boxes, scores, class_ids, args.iou),
+                                 args.repeats)
+        print(f"{num_candidates:>10} {len(vector_keep):>6} {loop_ms:>10.2f} {vector_ms:>10.2f} "
+              f"{loop_ms / vector_ms:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import multiprocessing
+from multiprocessing import shared_memory
+import cv2
+import numpy as np
+
+class SharedFrameRing:
+    """
+    Fixed number of uint8 frame slots in one shared memory block, for handing frames
+    between processes without pickling them. Only slot ids travel through the free and
+    filled queues, the frames never leave shared memory.
+    The producer acquires a free slot, writes the frame into it (cv2.VideoCapture.read
+    can decode straight into it) and publishes it. Consumers get numpy views of the
+    filled slots, which YOLOv8, Utils.draw_detections and the video writers take as is,
+    and release each slot once nothing reads it anymore.
+    Create the ring in the parent process and pass it to the others as a Process
+    argument, they attach to the same memory and queues.
+    @param _numSlots: frames in flight between the processes
+    @param _frameShape: (height, width, channels) of every frame
+    @param _context: multiprocessing context the processes are started from
+    """
+    def __init__(self, _numSlots, _frameShape, _context=None):
+        context = _context or multiprocessing.get_context("spawn")
+        self.num_slots = _numSlots
+        self.frame_shape = tuple(_frameShape)
+        self.memory = shared_memory.SharedMemory(create=True, size=_numSlots * int(np.prod(self.frame_shape)))
+        self.owner = True
+        self.free_slots = context.Queue()
+        self.filled_slots = context.Queue()
+        for slot in range(_numSlots):
+            self.free_slots.put(slot)
+        self.slots = self.createViews()
+
+    def createViews(self):
+        return list(np.ndarray((self.num_slots,) + self.frame_shape, dtype=np.uint8, buffer=self.memory.buf))
+
+    def __getstate__(self):
+        return {'num_slots': self.num_slots, 'frame_shape': self.frame_shape, 'name': self.memory.name,
+                'free_slots': self.free_slots, 'filled_slots': self.filled_slots}
+
+    def __setstate__(self, _state):
+        self.num_slots = _state['num_slots']
+        self.frame_shape = _state['frame_shape']
+        self.memory = shared_memory.SharedMemory(name=_state['name'])
+        self.owner = False
+        self.free_slots = _state['free_slots']
+        self.filled_slots = _state['filled_slots']
+        self.slots = self.createViews()
+
+    def acquire(self, _timeout=None):
+        """
+        Producer side, blocks until a slot is free
+        @return slot id and the frame to write into, raises queue.Empty on timeout
+        """
+        slot = self.free_slots.get(timeout=_timeout)
+        return slot, self.slots[slot]
+
+    def publish(self, _slot, _frameIndex):
+        """Hands the written slot to the consumers"""
+        self.filled_slots.put((_slot, _frameIndex))
+
+    def end(self, _numConsumers=1):
+        """Tells each consumer that no more frames follow"""
+        for _ in range(_numConsumers):
+            self.filled_slots.put(None)
+
+    def get(self, _timeout=None):
+        """
+        Consumer side, blocks until a frame is published
+        @return (frame index, frame, slot id), None once the producer ended. Raises
+                queue.Empty on timeout
+        """
+        item = self.filled_slots.get(timeout=_timeout)
+        if item is None:
+            return None
+        slot, frame_index = item
+        return frame_index, self.slots[slot], slot
+
+    def release(self, _slot):
+        """Returns the slot to the producer, its frame must not be used afterwards"""
+        self.free_slots.put(_slot)
+
+    def releaser(self, _slot):
+        """release as a callback, for consumers done with the frame on another thread, e.g. FFmpegVideoWriter"""
+        return lambda: self.release(_slot)
+
+    def close(self):
+        """
+        Unmaps the slots in this process, the creating process also frees the memory.
+        Frames taken from the ring must be dropped before.
+        """
+        self.slots = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+def decodeToRing(_ring, _videoPath, _startFrame=0, _numFrames=None, _numConsumers=1):
+    """
+    Decodes _videoPath straight into the slots of _ring, meant as the target of the
+    decode process. Ends the ring when the video or segment is done.
+        @param _numFrames: number of frames to decode, None runs to the end
+
+        @return number of frames decoded
+    """
+    cap = cv2.VideoCapture(_videoPath)
+    if _startFrame > 0:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, _startFrame)
+    frame_index = _startFrame
+    try:
+        while cap.isOpened() and (_numFrames is None or frame_index < _startFrame + _numFrames):
+            slot, frame = _ring.acquire()
+            ret, decoded = cap.read(frame)
+            if not ret:
+                _ring.release(slot)
+                break
+            # cv2 allocates a new frame when the slot doesn't fit, e.g. a wrong frame shape
+            if decoded is not frame:
+                np.copyto(frame, decoded)
+            _ring.publish(slot, frame_index)
+            frame_index += 1
+    finally:
+        cap.release()
+        _ring.end(_numConsumers)
+    return frame_index - _startFrame
@@ -1,3 +1,6 @@
+import argparse
+import shutil
+import time
 import cv2
 import numpy as np
 import onnxruntime as ort
@@ -5,6 +8,13 @@ import VideoUtils
 from PIL import Image
 import os
 from yolov8 import YOLOv8
+from yolov8.detections import DetectionRecorder
+from yolov8.tracker import KeyframeTracker
+from yolov8.motion_gate import MotionGate
+from yolov8.resolution_policy import LatencyBudgetPolicy
+from yolov8.profiler import StageProfiler
+from yolov8.detection_cache import DetectionCache
+from VideoPipeline import VideoPipeline
 
 VIDEO_PATH = "D:\Datasets\Samples\SurgicalVideos"
 MODEL_PATH = ".\\models\\tool_tip_v4.onnx"
@@ -20,42 +30,258 @@ MODEL_INPUT_HEIGHT = 640
 CLASS_ID = 0
 CLASS_NAMES = ["tool_tip"]
 
+# ORT threading, 0 uses all cores. Lower these when several detectors share a machine
+INTRA_OP_THREADS = 0
+INTER_OP_THREADS = 0
+# Save a graph-optimized copy next to the model on the first run and reuse it afterwards
+CACHE_OPTIMIZED_MODEL = True
+
+# Run decode, preprocess, inference, render and encode on their own threads
+USE_PIPELINE = True
+PIPELINE_QUEUE_SIZE = 8
+
+# Run each eye of side-by-side stereo videos as its own view, both in one batch
+SPLIT_STEREO = True
+
+# Run the detector every KEYFRAME_INTERVAL frames and track the boxes in between,
+# 1 detects on every frame. Tracking runs sequentially since it needs the last result
+KEYFRAME_INTERVAL = 1
+TRACKER_MIN_CONFIDENCE = 0.3
+
+# Reuse the last detections while the mean gray level change of a downscaled frame
+# stays below this (0-255), 0 runs the detector on every frame
+MOTION_THRESHOLD = 0
+
+# Inference resolution of dynamic-shape models, None uses the detector default of 640
+INPUT_SIZE = None
+# Lower the resolution of dynamic-shape models while a detector run takes longer than
+# this many ms, 0 keeps it fixed. Runs sequentially since it resizes between frames
+LATENCY_BUDGET_MS = 0
+INPUT_SIZES = (320, 480, 640)
+
+# Keep the raw model outputs of every frame in this sqlite file so re-runs with other
+# thresholds skip inference, None turns the cache off. Evicts least recently used
+# frames beyond DETECTION_CACHE_SIZE_MB
+DETECTION_CACHE_PATH = None
+DETECTION_CACHE_SIZE_MB = 1024
+
+# Frames decoded ahead of the detector on a background thread, and the FFmpeg decoder
+# threads, 0 leaves them to OpenCV
+DECODE_QUEUE_SIZE = 16
+DECODER_THREADS = 0
+
+# Rendered videos are encoded by ffmpeg on a background thread when it is on the PATH,
+# with cv2's MP4V writer as the fallback
+VIDEO_CODEC = "libx264"
+VIDEO_PRESET = "veryfast"
+VIDEO_CRF = 23
+ENCODER_QUEUE_SIZE = 16
+
 def main():
-    yolov8_detector = YOLOv8(path=MODEL_PATH, class_names=CLASS_NAMES,
-                             conf_thres=CONF_THRESHOLD, iou_thres=IOU_THRESHOLD)
+    parser = argparse.ArgumentParser(description="Runs the YOLOv8 detector over a video. By default only the "
+                                                 "detections are saved; rendering and display are opt-in.")
+    parser.add_argument("--video", help="video to process", default=os.path.join(VIDEO_PATH, VIDEO_FILE))
+    parser.add_argument("--output-dir", help="where detections and rendered videos go", default=OUTPUT_PATH)
+    parser.add_argument("--model", help="ONNX model path", default=MODEL_PATH)
+    parser.add_argument("--conf", type=float, help="confidence threshold", default=CONF_THRESHOLD)
+    parser.add_argument("--iou", type=float, help="NMS IoU threshold", default=IOU_THRESHOLD)
+    parser.add_argument("--render", action="store_true", help="also write a video with the detections drawn")
+    parser.add_argument("--show", action="store_true", help="display frames while processing, needs a GUI")
+    parser.add_argument("--sequential", action="store_true", default=not USE_PIPELINE,
+                        help="process one frame at a time instead of pipelining the stages")
+    parser.add_argument("--full-frame", action="store_true", default=not SPLIT_STEREO,
+                        help="run stereo videos as one side-by-side frame instead of one view per eye")
+    parser.add_argument("--keyframe-interval", type=int, default=KEYFRAME_INTERVAL,
+                        help="run the detector every N frames and track boxes in between")
+    parser.add_argument("--motion-threshold", type=float, default=MOTION_THRESHOLD,
+                        help="reuse the last detections on frames that changed less than this (0-255)")
+    parser.add_argument("--input-size", type=int, default=INPUT_SIZE,
+                        help="inference resolution of dynamic-shape models, e.g. 320 for fast previews")
+    parser.add_argument("--latency-budget", type=float, default=LATENCY_BUDGET_MS,
+                        help="switch dynamic-shape models between 320, 480 and 640 to stay under this many ms")
+    parser.add_argument("--codec", default=VIDEO_CODEC, help="ffmpeg encoder of the rendered video")
+    parser.add_argument("--preset", default=VIDEO_PRESET, help="ffmpeg encoder preset, e.g. ultrafast to veryslow")
+    parser.add_argument("--crf", type=int, default=VIDEO_CRF, help="constant rate factor, lower is higher quality")
+    parser.add_argument("--cache", metavar="PATH", default=DETECTION_CACHE_PATH,
+                        help="sqlite file caching the raw model outputs, re-runs with new thresholds skip inference")
+    parser.add_argument("--cache-size", type=float, default=DETECTION_CACHE_SIZE_MB,
+                        help="MB of cached outputs to keep, least recently used frames are evicted")
+    parser.add_argument("--profile", metavar="PATH",
+                        help="record per stage timings and save their percentiles to PATH, .csv or .json")
+    args = parser.parse_args()
 
-    cv2.namedWindow("Detected Objects", cv2.WINDOW_NORMAL)
+    profiler = StageProfiler() if args.profile else None
+    cache = DetectionCache(args.cache, args.cache_size) if args.cache else None
+    yolov8_detector = buildDetector(args.model, args.conf, args.iou, _inputSize=args.input_size, _profiler=profiler,
+                                    _cache=cache)
+    processVideo(yolov8_detector, args.video, args.output_dir, _render=args.render, _show=args.show,
+                 _pipelined=not args.sequential, _splitStereo=not args.full_frame,
+                 _keyframeInterval=args.keyframe_interval, _motionThreshold=args.motion_threshold,
+                 _latencyBudget=args.latency_budget, _codec=args.codec, _preset=args.preset, _crf=args.crf)
 
+    if cache is not None:
+        print(f"Detection cache hits: {cache.hits} of {cache.hits + cache.misses} runs")
+        cache.close()
+    if profiler is not None:
+        print(profiler.summary())
+        profiler.save(args.profile)
+        print("Stage timings saved to ", args.profile)
+
+def buildDetector(_modelPath, _confThreshold=CONF_THRESHOLD, _iouThreshold=IOU_THRESHOLD,
+                  _intraOpThreads=INTRA_OP_THREADS, _interOpThreads=INTER_OP_THREADS, _inputSize=INPUT_SIZE,
+                  _profiler=None, _cache=None):
+    optimized_model_path = None
+    if CACHE_OPTIMIZED_MODEL:
+        optimized_model_path = os.path.splitext(_modelPath)[0] + "_optimized.onnx"
+    return YOLOv8(path=_modelPath, class_names=CLASS_NAMES,
+                  conf_thres=_confThreshold, iou_thres=_iouThreshold,
+                  intra_op_num_threads=_intraOpThreads,
+                  inter_op_num_threads=_interOpThreads,
+                  optimized_model_path=optimized_model_path,
+                  input_size=_inputSize,
+                  profiler=_profiler,
+                  cache=_cache)
+
+def processVideo(_detector, _videoPath, _outputDir, _render=False, _show=False, _pipelined=USE_PIPELINE,
+                 _splitStereo=SPLIT_STEREO, _keyframeInterval=KEYFRAME_INTERVAL, _motionThreshold=MOTION_THRESHOLD,
+                 _startFrame=0, _numFrames=None, _outputName=None, _latencyBudget=LATENCY_BUDGET_MS,
+                 _codec=VIDEO_CODEC, _preset=VIDEO_PRESET, _crf=VIDEO_CRF):
+    """
+    Runs _detector over every frame of _videoPath and saves the detections to
+    <_outputDir>/<_outputName>_detections.npz
+        @param _render: also write <video name>_PROCESSED.mp4 with the tracked class drawn
+        @param _show: display the rendered frames, this always runs sequentially
+        @param _splitStereo: detect on each eye of stereo videos, the rendered video
+                             then shows the left eye
+        @param _keyframeInterval: detect every N frames and track in between, this
+                                  always runs sequentially
+        @param _motionThreshold: reuse the last detections on frames that changed less
+                                 than this, 0 turns the gate off
+        @param _startFrame: first frame to process, detections keep the frame numbers
+                            of the whole video
+        @param _numFrames: number of frames to process, None runs to the end
+        @param _outputName: base name of the output files, defaults to the video name
+        @param _latencyBudget: ms per detector run to keep dynamic-shape models under by
+                               switching between INPUT_SIZES, this always runs sequentially.
+                               Ignored with a warning for fixed-shape models
+        @param _codec, _preset, _crf: ffmpeg encoding of the rendered video
+
+        @return number of frames processed
+    """
     # Open the video file
-    video_full_path = os.path.join(VIDEO_PATH,VIDEO_FILE)
-    cap = cv2.VideoCapture(video_full_path)
-    print("Opened video ", video_full_path)
+    cap = VideoUtils.ThreadedVideoCapture(_videoPath, DECODE_QUEUE_SIZE, DECODER_THREADS)
+
+    # Check if the video file opened successfully
+    if not cap.isOpened():
+        print("Error opening video file ", _videoPath)
+        return 0
+    print("Opened video ", _videoPath)
+
+    if _startFrame > 0:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, _startFrame)
+    if _numFrames is not None:
+        cap = VideoUtils.CaptureSegment(cap, _numFrames)
+
+    video_name = _outputName or os.path.splitext(os.path.basename(_videoPath))[0]
+    stereo = _splitStereo and VideoUtils.isDimsStereo(int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                                                      int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    output_video = None
+    if _render:
+        output_video = createVideoWriter(cap, os.path.join(_outputDir, video_name + "_PROCESSED.mp4"), stereo,
+                                         _codec, _preset, _crf)
+
+    if _latencyBudget > 0 and not _detector.dynamic_input_size:
+        print(f"Ignoring the latency budget, the model input size is fixed at "
+              f"{_detector.input_height}x{_detector.input_width}")
+        _latencyBudget = 0
 
+    recorder = DetectionRecorder(frame_offset=_startFrame)
+    gate = MotionGate(threshold=_motionThreshold) if _motionThreshold > 0 else None
+    tracker = None
+    policy = None
+    try:
+        if _pipelined and not _show and _keyframeInterval <= 1 and _latencyBudget <= 0:
+            render = None
+            if output_video is not None:
+                render = lambda frame, detections: renderDetections(_detector, frame, detections)
+            pipeline = VideoPipeline(_detector, cap, output_video, _render=render, _onDetections=recorder.add_views,
+                                     _queueSize=PIPELINE_QUEUE_SIZE, _stereo=stereo, _gate=gate)
+            num_frames = pipeline.run()
+            fps = pipeline.fps()
+        else:
+            detect = lambda frame: detectViews(_detector, frame, stereo)
+            if _latencyBudget > 0:
+                policy = LatencyBudgetPolicy(detect, _detector, _latencyBudget, INPUT_SIZES)
+                detect = policy
+            if _keyframeInterval > 1:
+                tracker = KeyframeTracker(detect, _detector.utils, interval=_keyframeInterval,
+                                          min_confidence=TRACKER_MIN_CONFIDENCE)
+                detect = tracker
+            if gate is not None:
+                gate.detect = detect
+                detect = gate
+
+            num_frames, fps = runSequential(_detector, cap, output_video, recorder, detect, _show)
+    finally:
+        # Stops the decoder thread, also when the detector or the writer failed
+        cap.release()
+
+    if gate is not None:
+        print(f"Reused detections on {gate.num_skipped} of {gate.num_frames} frames")
+    if tracker is not None:
+        print(f"Detector ran on {tracker.detection_ratio() * 100:.1f}% of frames")
+    if policy is not None:
+        print("Detector runs per input size: ", policy.frames_per_size)
+
+    # Save before finishing the video, a failed encode must not cost the detections
+    detections_path = os.path.join(_outputDir, video_name + "_detections.npz")
+    try:
+        recorder.save(detections_path)
+    finally:
+        if output_video is not None:
+            output_video.release()
+    print(f"Processed {num_frames} frames at {fps:.1f} FPS, detections saved to {detections_path}")
+    return num_frames
+
+def createVideoWriter(_cap, _outputFile, _stereo, _codec=VIDEO_CODEC, _preset=VIDEO_PRESET, _crf=VIDEO_CRF):
+    """
+    Writer for the rendered video, an FFmpegVideoWriter when ffmpeg is available so
+    encoding overlaps inference, otherwise a cv2.VideoWriter on the calling thread
+    """
     # Read video properties
-    frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    isStereo = VideoUtils.isDimsStereo(frame_width, frame_height)
-    if isStereo:
-        frame_width /= 2 # monoscopic
+    frame_width = int(_cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    frame_height = int(_cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    if _stereo:
+        frame_width //= 2 # monoscopic
 
     # Create video writer
-    output_file_name = os.path.join(OUTPUT_PATH,VIDEO_FILE.split(".")[0]+"_PROCESSED.mp4")
-    fps = cap.get(cv2.CAP_PROP_FPS)
+    fps = _cap.get(cv2.CAP_PROP_FPS)
     fps = 15 #TODO: remove this cuz surgery video is broken
-    output_video = cv2.VideoWriter(output_file_name, 0x7634706d, fps, (int(frame_width), frame_height))
+    if shutil.which('ffmpeg') is not None:
+        return VideoUtils.FFmpegVideoWriter(_outputFile, fps, (int(frame_width), frame_height), _codec, _preset, _crf,
+                                            _queueSize=ENCODER_QUEUE_SIZE)
+    print("ffmpeg not found, encoding with cv2.VideoWriter")
+    return cv2.VideoWriter(_outputFile, 0x7634706d, fps, (int(frame_width), frame_height))
 
-    # Check if the video file opened successfully
-    if not cap.isOpened():
-        print("Error opening video file")
-        return
-    
-    while cap.isOpened():
+def runSequential(_detector, _cap, _outputVideo, _recorder, _detect, _show=False):
+    """
+    Processes one frame at a time on the calling thread
+        @param _detect: function(frame) returning a list of (boxes, scores, class_ids), one per view
+
+        @return number of frames processed, frames per second
+    """
+    if _show:
+        cv2.namedWindow("Detected Objects", cv2.WINDOW_NORMAL)
+
+    frame_index = 0
+    start = time.perf_counter()
+    while _cap.isOpened():
         # Press key q to stop
-        if cv2.waitKey(1) == ord('q'):
+        if _show and cv2.waitKey(1) == ord('q'):
             break
         try:
             # Read frame from the video
-            ret, frame = cap.read()
+            ret, frame = _cap.read()
             if not ret:
                 break
         except Exception as e:
@@ -63,26 +289,56 @@ def main():
             continue
 
         # Update object localizer
-        boxes, scores, class_ids = yolov8_detector(frame)
-        tracked_boxes = []
-        tracked_scores = []
-        tracked_class_ids = []
-        for i in range(boxes.shape[0]):
-            if class_ids[i] == TRACKED_CLASS:
-                tracked_boxes.append(boxes[i])
-                tracked_scores.append(scores[i])
-                tracked_class_ids.append(class_ids[i])
-
-        combined_img = yolov8_detector.utils.draw_detections(
-            image=frame,
-            boxes=tracked_boxes,
-            scores=tracked_scores,
-            class_ids=tracked_class_ids,
-            mask_alpha=0.3
-        )
-        # cv2.imshow("Detected Objects", combined_img)
+        detections = _detect(frame)
+        _recorder.add_views(frame_index, detections)
+        frame_index += 1
+
+        if _outputVideo is None and not _show:
+            continue
+
+        combined_img = renderDetections(_detector, frame, detections)
+        if _show:
+            cv2.imshow("Detected Objects", combined_img)
         # Write the processed frame to the output video file
-        output_video.write(combined_img)
+        if _outputVideo is not None:
+            _outputVideo.write(combined_img)
+
+    elapsed = time.perf_counter() - start
+    return frame_index, frame_index / elapsed if elapsed > 0 else 0.0
+
+def detectViews(_detector, _frame, _stereo):
+    """
+    Runs _detector on the whole frame, or on both eyes of a stereo frame as one batch of 2
+
+        @return list of (boxes, scores, class_ids), one per view, boxes in view coordinates
+    """
+    if _stereo:
+        # Views into the frame, nothing is copied
+        return _detector.detect_batch([VideoUtils.getLeftImage(_frame), VideoUtils.getRightImage(_frame)])
+    return [_detector(_frame)]
+
+def renderDetections(_detector, _frame, _detections):
+    """Draws the tracked class onto the output frame. Stereo videos are written monoscopic, so only the left eye is drawn."""
+    boxes, scores, class_ids = _detections[0]
+    view = VideoUtils.getLeftImage(_frame) if len(_detections) > 1 else _frame
+    return drawTrackedDetections(_detector, view, boxes, scores, class_ids)
+
+def filterTrackedClass(_boxes, _scores, _classIds):
+    """Returns the detections of TRACKED_CLASS only"""
+    tracked = np.asarray(_classIds) == TRACKED_CLASS
+    return np.asarray(_boxes)[tracked], np.asarray(_scores)[tracked], np.asarray(_classIds)[tracked]
+
+def drawTrackedDetections(_detector, _frame, _boxes, _scores, _classIds):
+    """Draws the detections of TRACKED_CLASS onto _frame in place, it is not read again after rendering"""
+    tracked_boxes, tracked_scores, tracked_class_ids = filterTrackedClass(_boxes, _scores, _classIds)
+    return _detector.draw_detections(
+        image=_frame,
+        boxes=tracked_boxes,
+        scores=tracked_scores,
+        class_ids=tracked_class_ids,
+        mask_alpha=0.3,
+        out=_frame
+    )
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,269 @@
+import argparse
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import cv2
+from tqdm import tqdm
+import ONNXInferenceYOLOv8
+import VideoUtils
+from yolov8.detections import merge_detections
+
+# Number of worker processes, 0 uses one per core
+NUM_WORKERS = 0
+
+# Detector of a video pool worker, built once by initWorker
+_worker_detector = None
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs the detector over one video split into keyframe aligned "
+                                                 "segments, or over every video of a directory, on a pool of "
+                                                 "worker processes.")
+    parser.add_argument("--video-dir", help="process every video in this directory instead of one video")
+    parser.add_argument("--video", help="video to process",
+                        default=os.path.join(ONNXInferenceYOLOv8.VIDEO_PATH, ONNXInferenceYOLOv8.VIDEO_FILE))
+    parser.add_argument("--output-dir", help="where detections and rendered videos go",
+                        default=ONNXInferenceYOLOv8.OUTPUT_PATH)
+    parser.add_argument("--model", help="ONNX model path", default=ONNXInferenceYOLOv8.MODEL_PATH)
+    parser.add_argument("--conf", type=float, help="confidence threshold", default=ONNXInferenceYOLOv8.CONF_THRESHOLD)
+    parser.add_argument("--iou", type=float, help="NMS IoU threshold", default=ONNXInferenceYOLOv8.IOU_THRESHOLD)
+    parser.add_argument("--render", action="store_true", help="also write a video with the detections drawn")
+    parser.add_argument("--workers", type=int, help="worker processes, 0 uses one per core", default=NUM_WORKERS)
+    args = parser.parse_args()
+
+    if args.video_dir is not None:
+        processVideoDirectory(args.video_dir, args.output_dir, args.model, args.conf, args.iou, args.render,
+                              args.workers)
+        return
+    processVideoInSegments(args.video, args.output_dir, args.model, args.conf, args.iou, args.render, args.workers)
+
+def processVideoInSegments(_videoPath, _outputDir, _modelPath, _confThreshold, _iouThreshold, _render=False,
+                           _numWorkers=NUM_WORKERS):
+    """
+    Runs one detector process per segment of _videoPath and stitches the results into
+    the same files a single ONNXInferenceYOLOv8 run writes. Each worker gets an equal
+    share of the cores for its ORT session.
+        @param _numWorkers: number of segments and processes, 0 uses one per core
+
+        @return number of frames processed
+    """
+    cap = cv2.VideoCapture(_videoPath)
+    if not cap.isOpened():
+        print("Error opening video file ", _videoPath)
+        return 0
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    cap.release()
+
+    num_cores = len(getAvailableCores())
+    num_workers = _numWorkers or num_cores
+    keyframes = findKeyframes(_videoPath, fps)
+    if keyframes is None:
+        print("ffprobe not available, splitting at evenly spaced frames")
+    segments = planSegments(total_frames, num_workers, keyframes)
+    threads_per_worker = max(1, num_cores // len(segments))
+    print(f"Processing {_videoPath} as {len(segments)} segments with {threads_per_worker} threads each")
+
+    # Write the optimized model cache up front so the workers don't race on it
+    if ONNXInferenceYOLOv8.CACHE_OPTIMIZED_MODEL:
+        ONNXInferenceYOLOv8.buildDetector(_modelPath, _confThreshold, _iouThreshold)
+
+    video_name = os.path.splitext(os.path.basename(_videoPath))[0]
+    segment_dir = tempfile.mkdtemp(prefix=video_name + "_segments_", dir=_outputDir)
+    jobs = []
+    for i, (start, end) in enumerate(segments):
+        # The last segment runs to the end, the frame count in the header can be off
+        num_frames = end - start if i < len(segments) - 1 else None
+        jobs.append((_videoPath, segment_dir, _modelPath, _confThreshold, _iouThreshold, threads_per_worker,
+                     _render, start, num_frames, f"{video_name}_{i:03}"))
+
+    try:
+        start_time = time.perf_counter()
+        # Spawned workers don't inherit ORT thread pools or the parent's session
+        with multiprocessing.get_context("spawn").Pool(len(jobs)) as pool:
+            segment_names = pool.map(processSegment, jobs)
+        elapsed = time.perf_counter() - start_time
+
+        num_frames = merge_detections([os.path.join(segment_dir, name + "_detections.npz")
+                                       for name in segment_names],
+                                      os.path.join(_outputDir, video_name + "_detections.npz"))
+        if _render:
+            concatVideos([os.path.join(segment_dir, name + "_PROCESSED.mp4") for name in segment_names],
+                         os.path.join(_outputDir, video_name + "_PROCESSED.mp4"))
+    finally:
+        # Partial segments of a failed run are of no use either
+        shutil.rmtree(segment_dir, ignore_errors=True)
+
+    print(f"Processed {num_frames} frames at {num_frames / elapsed:.1f} FPS over {len(jobs)} processes")
+    return num_frames
+
+def processSegment(_job):
+    """Worker entry point, runs the detector over one segment and returns its output name"""
+    (video_path, output_dir, model_path, conf_threshold, iou_threshold, num_threads,
+     render, start_frame, num_frames, output_name) = _job
+    detector = ONNXInferenceYOLOv8.buildDetector(model_path, conf_threshold, iou_threshold,
+                                                 _intraOpThreads=num_threads, _interOpThreads=1)
+    ONNXInferenceYOLOv8.processVideo(detector, video_path, output_dir, _render=render,
+                                     _startFrame=start_frame, _numFrames=num_frames, _outputName=output_name)
+    return output_name
+
+def processVideoDirectory(_videoDir, _outputDir, _modelPath, _confThreshold, _iouThreshold, _render=False,
+                          _numWorkers=NUM_WORKERS):
+    """
+    Runs ONNXInferenceYOLOv8.processVideo over every video in _videoDir on a process
+    pool. Each worker builds its detector once, reuses it for all of its videos and is
+    pinned to its own share of the cores so the sessions don't oversubscribe them.
+        @param _numWorkers: number of worker processes, 0 uses one per core
+
+        @return total number of frames processed
+    """
+    videos = VideoUtils.getListOfVideos(os.path.join(_videoDir, ""))
+    if not videos:
+        return 0
+    # Longest videos first so a long one doesn't start last and run alone
+    videos.sort(key=os.path.getsize, reverse=True)
+
+    num_workers = min(_numWorkers or len(getAvailableCores()), len(videos))
+    core_sets = splitCores(num_workers)
+    print(f"Processing {len(videos)} videos on {num_workers} workers with {len(core_sets[0])} cores each")
+
+    # Write the optimized model cache up front so the workers don't race on it
+    if ONNXInferenceYOLOv8.CACHE_OPTIMIZED_MODEL:
+        ONNXInferenceYOLOv8.buildDetector(_modelPath, _confThreshold, _iouThreshold)
+
+    context = multiprocessing.get_context("spawn")
+    core_queue = context.Queue()
+    for cores in core_sets:
+        core_queue.put(cores)
+
+    total_frames = 0
+    start_time = time.perf_counter()
+    with context.Pool(num_workers, initializer=initWorker,
+                      initargs=(_modelPath, _confThreshold, _iouThreshold, core_queue)) as pool:
+        jobs = [(video_path, _outputDir, _render) for video_path in videos]
+        for num_frames in tqdm(pool.imap_unordered(processVideoInWorker, jobs), total=len(jobs),
+                               desc="Processing videos", colour="green"):
+            total_frames += num_frames
+    elapsed = time.perf_counter() - start_time
+
+    print(f"Processed {total_frames} frames of {len(videos)} videos at {total_frames / elapsed:.1f} FPS")
+    return total_frames
+
+def initWorker(_modelPath, _confThreshold, _iouThreshold, _coreQueue):
+    """Pool initializer, pins the worker to its cores and builds its detector"""
+    global _worker_detector
+    cores = _coreQueue.get()
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    _worker_detector = ONNXInferenceYOLOv8.buildDetector(_modelPath, _confThreshold, _iouThreshold,
+                                                         _intraOpThreads=len(cores), _interOpThreads=1)
+
+def processVideoInWorker(_job):
+    video_path, output_dir, render = _job
+    return ONNXInferenceYOLOv8.processVideo(_worker_detector, video_path, output_dir, _render=render)
+
+def splitCores(_numWorkers):
+    """
+    Splits the cores this process may run on into _numWorkers contiguous sets. Workers
+    share cores round robin when there are more workers than cores.
+
+        @return list of core id lists
+    """
+    cores = getAvailableCores()
+    core_sets = []
+    for i in range(_numWorkers):
+        cores_of_worker = cores[i * len(cores) // _numWorkers:(i + 1) * len(cores) // _numWorkers]
+        core_sets.append(cores_of_worker or [cores[i % len(cores)]])
+    return core_sets
+
+def getAvailableCores():
+    """Returns the sorted ids of the cores this process may run on"""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+def findKeyframes(_videoPath, _fps):
+    """
+    Lists the keyframes of the first video stream with ffprobe. Segments starting on a
+    keyframe decode from their first frame instead of the keyframe before it.
+
+        @return sorted frame numbers, None when ffprobe is not available
+    """
+    command = [
+        'ffprobe',
+        '-v', 'error',
+        '-select_streams', 'v:0',
+        '-skip_frame', 'nokey',
+        '-show_entries', 'frame=pts_time',
+        '-of', 'csv=p=0',
+        _videoPath
+    ]
+    try:
+        result = subprocess.run(command, capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    times = [float(line.strip(',')) for line in result.stdout.split() if line.strip(',') not in ("", "N/A")]
+    if not times:
+        return None
+    # Timestamps may not start at 0, the first frame is always a keyframe
+    return sorted({round((t - min(times)) * _fps) for t in times})
+
+def planSegments(_numFrames, _numSegments, _keyframes=None):
+    """
+    Splits _numFrames into up to _numSegments ranges of about equal length, moving every
+    boundary to the nearest keyframe when _keyframes is given
+
+        @return list of (start, end) frame ranges
+    """
+    boundaries = [0]
+    for i in range(1, _numSegments):
+        boundary = i * _numFrames // _numSegments
+        if _keyframes:
+            boundary = min(_keyframes, key=lambda keyframe: abs(keyframe - boundary))
+        # Segments too short to get their own keyframe are merged into the one before
+        if boundaries[-1] < boundary < _numFrames:
+            boundaries.append(boundary)
+    boundaries.append(max(_numFrames, boundaries[-1] + 1))
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+def concatVideos(_videoPaths, _outputPath):
+    """Joins videos with the same size and codec, without re-encoding when ffmpeg is available"""
+    if shutil.which('ffmpeg') is not None:
+        list_path = _outputPath + ".txt"
+        with open(list_path, 'w') as f:
+            for path in _videoPaths:
+                f.write(f"file '{os.path.abspath(path)}'\n")
+        command = [
+            'ffmpeg',
+            '-y',
+            '-v', 'error',
+            '-f', 'concat',
+            '-safe', '0',
+            '-i', list_path,
+            '-c', 'copy',
+            _outputPath
+        ]
+        subprocess.run(command, check=True)
+        os.remove(list_path)
+        return
+
+    writer = None
+    for path in _videoPaths:
+        cap = cv2.VideoCapture(path)
+        if writer is None:
+            writer = cv2.VideoWriter(_outputPath, 0x7634706d, cap.get(cv2.CAP_PROP_FPS),
+                                     (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))))
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            writer.write(frame)
+        cap.release()
+    if writer is not None:
+        writer.release()
+
+if __name__ == "__main__":
+    main()
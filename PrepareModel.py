@@ -0,0 +1,44 @@
+import argparse
+import os
+import onnx
+from yolov8 import model_tools
+
+MODEL_PATH = ".\\models\\tool_tip_v4.onnx"
+
+# Max detections per class and image of the NMS head
+NMS_MAX_DETECTIONS = 300
+
+def main():
+    parser = argparse.ArgumentParser(description="Bakes steps the detector runs in Python into the ONNX graph. "
+                                                 "YOLOv8 detects the changes from the model and adapts.")
+    parser.add_argument("--model", help="ONNX model to prepare", default=MODEL_PATH)
+    parser.add_argument("--output", help="where to save the prepared model, defaults to <model>_prepared.onnx")
+    parser.add_argument("--preprocess", action="store_true",
+                        help="take raw BGR uint8 frames and resize, swap to RGB and scale them in the graph")
+    parser.add_argument("--nms", action="store_true",
+                        help="decode boxes and run NMS in the graph, the model then outputs final detections")
+    parser.add_argument("--max-detections", type=int, default=NMS_MAX_DETECTIONS,
+                        help="max detections per class and image of the NMS head")
+    args = parser.parse_args()
+
+    output_path = args.output or os.path.splitext(args.model)[0] + "_prepared.onnx"
+    prepareModel(args.model, output_path, _preprocess=args.preprocess, _nms=args.nms,
+                 _maxDetections=args.max_detections)
+
+def prepareModel(_modelPath, _outputPath, _preprocess=False, _nms=False, _maxDetections=NMS_MAX_DETECTIONS):
+    """
+    Applies the selected model_tools edits to _modelPath and saves the result
+        @param _preprocess: see model_tools.add_preprocessing
+        @param _nms: see model_tools.add_nms
+    """
+    model = model_tools.load_model(_modelPath)
+    if _preprocess:
+        model_tools.add_preprocessing(model)
+    if _nms:
+        model_tools.add_nms(model, _maxDetections)
+
+    onnx.save(model, _outputPath)
+    print("Saved prepared model to ", _outputPath)
+
+if __name__ == "__main__":
+    main()
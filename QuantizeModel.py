@@ -0,0 +1,84 @@
+import argparse
+import os
+import random
+import cv2
+import VideoUtils
+from yolov8 import YOLOv8
+from yolov8.quantization import FrameCalibrationReader, quantize_model, compare_detectors
+
+MODEL_PATH = ".\\models\\tool_tip_v4.onnx"
+# Frames written by VideoToFrames.py / VideoUtils.getFrameFromVideo
+IMAGE_DIR = "E:\\Videos\\raw_frames\\"
+CLASS_NAMES = ["tool_tip"]
+CONF_THRESHOLD = 0.2
+IOU_THRESHOLD = 0.5
+
+# Frames used to calibrate, a few hundred cover the activation ranges well
+NUM_CALIBRATION_FRAMES = 300
+# Share of the videos whose frames are held out for the comparison
+HOLDOUT_FRACTION = 0.2
+NUM_HOLDOUT_FRAMES = 100
+
+def main():
+    parser = argparse.ArgumentParser(description="Writes an INT8 QDQ copy of a model calibrated on extracted frames "
+                                                 "and compares it against the FP32 model on held-out videos.")
+    parser.add_argument("--model", help="FP32 ONNX model", default=MODEL_PATH)
+    parser.add_argument("--output", help="where to save the INT8 model, defaults to <model>_int8.onnx")
+    parser.add_argument("--image-dir", help="extracted frames to calibrate and compare on", default=IMAGE_DIR)
+    parser.add_argument("--calibration-frames", type=int, default=NUM_CALIBRATION_FRAMES,
+                        help="number of frames to calibrate on")
+    parser.add_argument("--holdout-frames", type=int, default=NUM_HOLDOUT_FRAMES,
+                        help="number of held-out frames to compare on")
+    parser.add_argument("--calibrate-method", default="minmax", help="minmax, entropy or percentile")
+    parser.add_argument("--per-tensor", action="store_true", help="one weight scale per tensor instead of per channel")
+    args = parser.parse_args()
+
+    output_path = args.output or os.path.splitext(args.model)[0] + "_int8.onnx"
+    calibration_paths, holdout_paths = splitFramesByVideo(VideoUtils.getListOfImages(args.image_dir),
+                                                          HOLDOUT_FRACTION)
+    calibration_paths = calibration_paths[:args.calibration_frames]
+    holdout_paths = holdout_paths[:args.holdout_frames]
+    print(f"Calibrating on {len(calibration_paths)} frames, comparing on {len(holdout_paths)} held-out frames")
+
+    fp32_detector = YOLOv8(args.model, CLASS_NAMES, conf_thres=CONF_THRESHOLD, iou_thres=IOU_THRESHOLD)
+    quantize_model(args.model, output_path, FrameCalibrationReader(fp32_detector, calibration_paths),
+                   per_channel=not args.per_tensor, calibrate_method=args.calibrate_method)
+    print("Saved INT8 model to ", output_path)
+
+    int8_detector = YOLOv8(output_path, CLASS_NAMES, conf_thres=CONF_THRESHOLD, iou_thres=IOU_THRESHOLD)
+    report = compare_detectors(fp32_detector, int8_detector, [cv2.imread(path) for path in holdout_paths])
+    printReport(report)
+
+def splitFramesByVideo(_imagePaths, _holdoutFraction, _seed=0):
+    """
+    Splits frames into calibration and held-out sets by the video they came from, so
+    the comparison runs on videos the calibration never saw
+        @param _imagePaths: frames named <video>_FRM_<frame>_of_<total>.jpg
+
+        @return calibration paths, held-out paths, both shuffled
+    """
+    videos = sorted({os.path.basename(path).split("_FRM_")[0] for path in _imagePaths})
+    rng = random.Random(_seed)
+    rng.shuffle(videos)
+    num_holdout = max(1, round(len(videos) * _holdoutFraction)) if len(videos) > 1 else 0
+    holdout_videos = set(videos[:num_holdout])
+
+    calibration_paths = [path for path in _imagePaths if os.path.basename(path).split("_FRM_")[0] not in holdout_videos]
+    holdout_paths = [path for path in _imagePaths if os.path.basename(path).split("_FRM_")[0] in holdout_videos]
+    # A single video has nothing to hold out, so compare on its own frames
+    if not holdout_paths:
+        holdout_paths = list(calibration_paths)
+    rng.shuffle(calibration_paths)
+    rng.shuffle(holdout_paths)
+    return calibration_paths, holdout_paths
+
+def printReport(_report):
+    print(f"FP32 {_report['reference_ms']:.2f} ms, INT8 {_report['candidate_ms']:.2f} ms, "
+          f"speedup {_report['speedup']:.2f}x over {_report['images']} frames")
+    print(f"Detections FP32 {_report['reference_detections']}, INT8 {_report['candidate_detections']}, "
+          f"recall {_report['recall'] * 100:.1f}%, precision {_report['precision'] * 100:.1f}%")
+    print(f"Matched boxes: mean IoU {_report['mean_matched_iou']:.3f}, "
+          f"mean score delta {_report['mean_score_delta']:.4f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+import queue
+import threading
+import time
+import VideoUtils
+
+# Marks the end of the stream on a stage queue
+_END = object()
+
+# How often blocked stages check whether the pipeline was stopped, in seconds
+POLL_INTERVAL = 0.1
+
+class FrameJob:
+    """One frame moving through the pipeline"""
+    __slots__ = ("index", "frame", "views", "input_tensor", "outputs", "detections")
+
+    def __init__(self, _index, _frame):
+        self.index = _index
+        self.frame = _frame
+        self.views = None
+        self.input_tensor = None
+        self.outputs = None
+        self.detections = None
+
+class VideoPipeline:
+    """
+    Runs decode, preprocess, inference, postprocess, render and encode on separate
+    threads connected by bounded queues, so throughput is set by the slowest stage
+    instead of the sum of all of them. Every stage is a single thread reading a FIFO
+    queue, so frames stay in order. A full queue blocks the stage feeding it, which
+    keeps memory bounded when a later stage falls behind.
+    @param _detector: YOLOv8 detector. Its prepare_input, inference and process_output
+                      are each called from one stage thread only
+    @param _capture: opened cv2.VideoCapture or anything with read()
+    @param _writer: cv2.VideoWriter or anything with write(), None skips encoding
+    @param _render: function(frame, detections) returning the frame to encode, run on
+                    its own stage between postprocess and encode. None skips rendering
+    @param _onDetections: function(frame_index, detections) called in frame order
+    @param _queueSize: max frames waiting between two stages
+    @param _stereo: split side-by-side stereo frames and run both eyes as one batch
+    @param _gate: optional MotionGate. Frames it calls static skip preprocess and
+                  inference and reuse the detections of the frame before
+    Detections are passed as a list of (boxes, scores, class_ids), one per view: the
+    whole frame, or the left and right eye with boxes in eye coordinates.
+    """
+    def __init__(self, _detector, _capture, _writer=None, _render=None, _onDetections=None, _queueSize=8,
+                 _stereo=False, _gate=None):
+        self.detector = _detector
+        self.capture = _capture
+        self.writer = _writer
+        self.render_function = _render
+        self.on_detections = _onDetections
+        self.queue_size = _queueSize
+        self.stereo = _stereo
+        self.gate = _gate
+        self.last_detections = None
+        self.num_views = 2 if _stereo else 1
+
+        self.stop_event = threading.Event()
+        self.errors = []
+        self.num_frames = 0
+        self.elapsed = 0.0
+
+        # Input tensors are recycled between preprocess and inference. One per queue
+        # slot plus one being filled and one being run is enough to never block on it.
+        # They are allocated on the first frame, raw frame inputs take the frame size
+        self.free_tensors = None
+
+    def run(self):
+        """
+        Processes the whole video and blocks until every stage has finished.
+        @return number of frames processed
+        """
+        stages = [self.decode, self.preprocess, self.infer, self.postprocess]
+        if self.writer is not None:
+            if self.render_function is not None:
+                stages.append(self.render)
+            stages.append(self.encode)
+
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(stages) - 1)]
+        threads = []
+        for i, stage in enumerate(stages):
+            input_queue = queues[i - 1] if i > 0 else None
+            output_queue = queues[i] if i < len(queues) else None
+            threads.append(threading.Thread(target=self.runStage, args=(stage, input_queue, output_queue),
+                                            name=stage.__name__, daemon=True))
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                # Join in short steps so Ctrl+C still reaches the main thread
+                while thread.is_alive():
+                    thread.join(POLL_INTERVAL)
+        except KeyboardInterrupt:
+            self.stop()
+            for thread in threads:
+                thread.join()
+            raise
+        self.elapsed = time.perf_counter() - start
+
+        if self.errors:
+            raise self.errors[0]
+        return self.num_frames
+
+    def stop(self):
+        """Asks every stage to finish as soon as possible"""
+        self.stop_event.set()
+
+    def fps(self):
+        return self.num_frames / self.elapsed if self.elapsed > 0 else 0.0
+
+    def runStage(self, _stage, _inputQueue, _outputQueue):
+        try:
+            if _inputQueue is None:
+                # Source stage, it yields jobs until the video ends
+                for job in _stage():
+                    if not self.put(_outputQueue, job):
+                        break
+            else:
+                while True:
+                    job = self.get(_inputQueue)
+                    if job is _END:
+                        break
+                    job = _stage(job)
+                    if _outputQueue is not None and not self.put(_outputQueue, job):
+                        break
+        except BaseException as e:
+            self.errors.append(e)
+            self.stop()
+        finally:
+            if _outputQueue is not None:
+                self.put(_outputQueue, _END)
+
+    def put(self, _queue, _item):
+        """Blocks while _queue is full. Returns False if the pipeline was stopped meanwhile."""
+        while True:
+            try:
+                _queue.put(_item, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                if self.stop_event.is_set():
+                    return False
+
+    def get(self, _queue):
+        """Blocks while _queue is empty. Returns _END if the pipeline was stopped meanwhile."""
+        while True:
+            try:
+                return _queue.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                if self.stop_event.is_set():
+                    return _END
+
+    def decode(self):
+        index = 0
+        while not self.stop_event.is_set():
+            ret, frame = self.capture.read()
+            if not ret:
+                break
+            yield FrameJob(index, frame)
+            index += 1
+
+    def preprocess(self, _job):
+        if self.gate is not None and not self.gate.should_detect(_job.frame):
+            return _job
+
+        if self.stereo:
+            # Views into the frame, nothing is copied
+            _job.views = [VideoUtils.getLeftImage(_job.frame), VideoUtils.getRightImage(_job.frame)]
+        else:
+            _job.views = [_job.frame]
+
+        if self.free_tensors is None:
+            self.allocateTensors(_job.views[0].shape)
+        _job.input_tensor = self.free_tensors.get()
+        for i, view in enumerate(_job.views):
+            self.detector.prepare_input(view, out=_job.input_tensor[i:i + 1])
+        return _job
+
+    def allocateTensors(self, _viewShape):
+        self.free_tensors = queue.Queue()
+        for _ in range(self.queue_size + 2):
+            self.free_tensors.put(self.detector.new_input_tensor(self.num_views, _viewShape))
+
+    def infer(self, _job):
+        if _job.input_tensor is None:
+            return _job
+
+        outputs = self.detector.inference_batch(_job.input_tensor)
+        # IO binding reuses its output buffers on the next run, which happens before
+        # postprocess gets to this frame
+        if self.detector.io_binding is not None:
+            outputs = [output.copy() for output in outputs]
+        _job.outputs = outputs
+
+        self.free_tensors.put(_job.input_tensor)
+        _job.input_tensor = None
+        return _job
+
+    def postprocess(self, _job):
+        if _job.outputs is None:
+            # Static frame, frames reach this stage in order so these are the previous frame's
+            _job.detections = self.last_detections
+        else:
+            _job.detections = [self.detector.process_output(self.detector.slice_outputs(_job.outputs, i, i + 1),
+                                                            view.shape[:2])
+                               for i, view in enumerate(_job.views)]
+            self.last_detections = _job.detections
+        _job.outputs = None
+        _job.views = None
+
+        if self.on_detections is not None:
+            self.on_detections(_job.index, _job.detections)
+
+        self.num_frames += 1
+        return _job
+
+    def render(self, _job):
+        _job.frame = self.render_function(_job.frame, _job.detections)
+        return _job
+
+    def encode(self, _job):
+        self.writer.write(_job.frame)
+        return _job
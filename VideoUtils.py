@@ -2,8 +2,12 @@ from ctypes import sizeof
 from os import listdir
 from os.path import isfile, join, basename, splitext
 import glob
+import queue
 import shutil
+import subprocess
+import threading
 import cv2
+import numpy as np
 
 def getListOfVideos(_dir):
     """Returns list of videos found in _dir""" 
@@ -34,7 +38,7 @@ def getFrameFromVideo(_videoName, _frameRate, _outputDir):
     """Gets a frame from _videoName every _frameRate frames. Dumps the
     images into _outputDir."""
     print("Trying to open ", _videoName)
-    cap = cv2.VideoCapture(_videoName)
+    cap = ThreadedVideoCapture(_videoName)
     if (cap.isOpened()):
         print("Opened ", _videoName, " SUCCESSFULLY!")
         total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
@@ -54,6 +58,7 @@ def getFrameFromVideo(_videoName, _frameRate, _outputDir):
             cv2.imwrite(_outputDir + vidName + "_FRM_" + f'{frame_num:06}' + "_of_" + f'{int(cap.get(cv2.CAP_PROP_FRAME_COUNT)):06}' + ".jpg",frame)
     else:
         print("Failed to open ", _videoName)
+    cap.release()
 
 def getList(dict):
     list = []
@@ -113,7 +118,7 @@ def getSelectFramesFromVideo(_videoPath, _frameList, _outputDir):
         @return list of frames that failed to copy for _videoPath
     """
     print("Trying to open ", _videoPath)
-    cap = cv2.VideoCapture(_videoPath)
+    cap = ThreadedVideoCapture(_videoPath)
     videoName = basename(_videoPath)
     _failedFrameList = _frameList.copy()
     if (cap.isOpened()):
@@ -137,5 +142,210 @@ def getSelectFramesFromVideo(_videoPath, _frameList, _outputDir):
             _failedFrameList.remove(f)
     else:
         print("Failed to open ", videoName)
+    cap.release()
     
-    return _failedFrameList
\ No newline at end of file
+    return _failedFrameList
+
+class ThreadedVideoCapture:
+    """
+    cv2.VideoCapture that decodes ahead on a background thread into a queue of up to
+    _queueSize frames, so decoding overlaps whatever the caller does with the frames.
+    read(), set(), get(), isOpened() and release() behave like cv2.VideoCapture. An
+    exception of the decoder is raised by read() and ends the video.
+    Seeking forward by up to _maxSkip frames reads through the decoded frames instead
+    of seeking, which is what reading every Nth frame does. Longer seeks restart the
+    decoder at the new position.
+    get() of properties other than the frame size, fps, frame count, fourcc and
+    position asks the capture while the thread may be decoding.
+        @param _decoderThreads: threads of the FFmpeg decoder, 0 leaves it to OpenCV
+    """
+    def __init__(self, _source, _queueSize=16, _decoderThreads=0, _maxSkip=60):
+        params = [cv2.CAP_PROP_N_THREADS, _decoderThreads] if _decoderThreads > 0 else []
+        self.cap = cv2.VideoCapture(_source, cv2.CAP_ANY, params)
+        self.queue_size = _queueSize
+        self.max_skip = _maxSkip
+
+        # These don't change while decoding, so they are read once before the thread starts
+        self.properties = {prop: self.cap.get(prop) for prop in (cv2.CAP_PROP_FRAME_WIDTH, cv2.CAP_PROP_FRAME_HEIGHT,
+                                                                 cv2.CAP_PROP_FPS, cv2.CAP_PROP_FRAME_COUNT,
+                                                                 cv2.CAP_PROP_FOURCC)}
+        # Index of the frame the next read() returns
+        self.position = 0
+        self.thread = None
+        self.start()
+
+    def start(self):
+        if not self.cap.isOpened():
+            return
+        self.frames = queue.Queue(maxsize=self.queue_size)
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.decode, args=(self.frames, self.stop_event), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+
+    def decode(self, _frames, _stopEvent):
+        while not _stopEvent.is_set():
+            try:
+                ret, frame = self.cap.read()
+            except Exception as e:
+                # Handed to read(), which raises it on the caller's thread and ends the video
+                ret, frame = False, e
+            while not _stopEvent.is_set():
+                try:
+                    _frames.put((ret, frame), timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if not ret:
+                break
+
+    def isOpened(self):
+        return self.cap.isOpened()
+
+    def read(self):
+        if self.thread is None:
+            return False, None
+        ret, frame = self.frames.get()
+        if ret:
+            self.position += 1
+            return ret, frame
+
+        # Leave the end of the video for the next read
+        self.frames.put((False, None))
+        if isinstance(frame, Exception):
+            raise frame
+        return ret, frame
+
+    def grab(self):
+        return self.read()[0]
+
+    def set(self, _prop, _value):
+        if _prop == cv2.CAP_PROP_POS_FRAMES and self.position <= int(_value) <= self.position + self.max_skip:
+            while self.position < int(_value):
+                if not self.read()[0]:
+                    return False
+            return True
+
+        self.stop()
+        result = self.cap.set(_prop, _value)
+        self.position = int(self.cap.get(cv2.CAP_PROP_POS_FRAMES))
+        self.start()
+        return result
+
+    def get(self, _prop):
+        if _prop == cv2.CAP_PROP_POS_FRAMES:
+            return float(self.position)
+        if _prop in self.properties:
+            return self.properties[_prop]
+        return self.cap.get(_prop)
+
+    def release(self):
+        self.stop()
+        self.cap.release()
+
+class CaptureSegment:
+    """
+    Wraps an opened cv2.VideoCapture so read() ends the video after _numFrames frames.
+    Everything else is forwarded to the capture. Seek the capture to the first frame
+    of the segment before wrapping it.
+    """
+    def __init__(self, _cap, _numFrames):
+        self.cap = _cap
+        self.remaining = _numFrames
+
+    def read(self):
+        if self.remaining <= 0:
+            return False, None
+        self.remaining -= 1
+        return self.cap.read()
+
+    def __getattr__(self, _name):
+        return getattr(self.cap, _name)
+
+class FFmpegVideoWriter:
+    """
+    Drop-in replacement for cv2.VideoWriter that encodes on an ffmpeg subprocess.
+    write() only queues the frame; a writer thread streams the raw BGR frames to
+    ffmpeg's stdin, so encoding runs alongside the caller instead of on its thread.
+    write() blocks once _queueSize frames are waiting. Frames are not copied, so
+    don't modify or reuse one before it is written, see write's _onWritten.
+        @param _frameSize: (width, height) like cv2.VideoWriter, odd sizes are padded
+                           by one pixel since yuv420p needs even dimensions
+        @param _codec: ffmpeg encoder, e.g. libx264 or libx265
+        @param _preset: encoder speed preset, slower presets give smaller files
+        @param _crf: constant rate factor, lower is better quality and larger files
+    """
+    def __init__(self, _outputFile, _fps, _frameSize, _codec='libx264', _preset='veryfast', _crf=23, _queueSize=8):
+        self.frame_size = tuple(int(size) for size in _frameSize)
+        command = [
+            'ffmpeg', '-y',
+            '-loglevel', 'error',
+            '-f', 'rawvideo',
+            '-pix_fmt', 'bgr24',
+            '-s', f'{self.frame_size[0]}x{self.frame_size[1]}',
+            '-r', str(_fps),
+            '-i', '-',
+            '-an',
+            '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2',
+            '-c:v', _codec,
+            '-preset', _preset,
+            '-crf', str(_crf),
+            '-pix_fmt', 'yuv420p',
+            _outputFile
+        ]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+        self.frames = queue.Queue(maxsize=_queueSize)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def isOpened(self):
+        return self.process.poll() is None and self.error is None
+
+    def write(self, _frame, _onWritten=None):
+        """
+        @param _onWritten: function() called from the writer thread once the frame is
+                           no longer needed, e.g. SharedFrameRing.releaser of its slot
+        Raises RuntimeError once ffmpeg has exited, e.g. on an unknown codec or preset,
+        so a run fails at its first frames instead of when the writer is released
+        """
+        if not self.isOpened():
+            raise RuntimeError(f"ffmpeg exited with code {self.process.poll()}: {self.error}")
+        if _frame.shape[1::-1] != self.frame_size:
+            raise ValueError(f"Frame size {_frame.shape[1::-1]} does not match the writer size {self.frame_size}")
+        self.frames.put((_frame, _onWritten))
+
+    def run(self):
+        while True:
+            item = self.frames.get()
+            if item is None:
+                break
+            frame, on_written = item
+            # Keep draining after a failure so write() never blocks on a full queue
+            if self.error is None:
+                try:
+                    self.process.stdin.write(np.ascontiguousarray(frame).data)
+                except OSError as e:
+                    self.error = e
+            frame = None
+            if on_written is not None:
+                on_written()
+
+    def release(self):
+        """Waits for the queued frames to be encoded and ffmpeg to finish the file"""
+        if self.process.stdin.closed:
+            return
+        self.frames.put(None)
+        self.thread.join()
+        try:
+            self.process.stdin.close()
+        except OSError as e:
+            self.error = self.error or e
+        return_code = self.process.wait()
+        if self.error is not None or return_code != 0:
+            raise RuntimeError(f"ffmpeg failed with exit code {return_code}: {self.error}")
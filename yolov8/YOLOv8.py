@@ -1,3 +1,5 @@
+import ast
+import os
 import time
 import cv2
 import numpy as np
@@ -5,35 +7,172 @@ import onnxruntime
 
 # from yolov8.utils import xywh2xyxy, draw_detections, multiclass_nms
 from yolov8.utils import Utils
+from yolov8.model_metadata import RAW_BGR_PREPROCESS, EMBEDDED_NMS_POSTPROCESS, CONF_THRESHOLD_INPUT, \
+    IOU_THRESHOLD_INPUT
+
+EXECUTION_MODES = {
+    'sequential': onnxruntime.ExecutionMode.ORT_SEQUENTIAL,
+    'parallel': onnxruntime.ExecutionMode.ORT_PARALLEL,
+}
+
+GRAPH_OPTIMIZATION_LEVELS = {
+    'disable': onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    'basic': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    'extended': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    'all': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+# Inference resolution of dynamic-shape models when none is given
+DEFAULT_INPUT_SIZE = 640
+# YOLOv8 downsamples by up to 32, so dynamic input sizes must be multiples of it
+INPUT_SIZE_STRIDE = 32
+
+ONNX_TO_NUMPY_TYPES = {
+    'tensor(float)': np.float32,
+    'tensor(float16)': np.float16,
+    'tensor(double)': np.float64,
+}
 
 class YOLOv8:
     """
     YOLOv8 object detector class
-    @param path: path to the ONNX model
+    @param path: path to the ONNX model. Models prepared with PrepareModel.py --preprocess
+                 take raw BGR uint8 frames and skip the preprocessing in Python, models
+                 prepared with --nms output final detections and skip NMS in Python
     @param class_names: list of class names
     @param conf_thres: confidence threshold as float
     @param iou_thres: IoU threshold as float
+    @param use_io_binding: bind persistent input and output buffers to the session
+                           once instead of passing fresh arrays on every run
+    @param intra_op_num_threads: threads used inside an op, 0 lets ORT use all cores
+    @param inter_op_num_threads: threads used across ops in parallel execution mode, 0 lets ORT decide
+    @param execution_mode: 'sequential' or 'parallel'
+    @param graph_optimization_level: 'disable', 'basic', 'extended' or 'all'
+    @param optimized_model_path: where to save the graph-optimized model, tagged with the
+                                 optimization level and ORT version. Later starts with the same
+                                 level and version load it directly and skip optimization while
+                                 it is newer than path
+    @param max_candidates: keep only the top scoring candidates above conf_thres before NMS,
+                           None keeps them all. Not used with models that run NMS themselves
+    @param input_size: inference resolution of dynamic-shape models as an int or (height, width),
+                       see set_input_size. Defaults to DEFAULT_INPUT_SIZE, fixed-shape models
+                       only accept their own size
+    @param profiler: StageProfiler that records the time of every preprocess, inference,
+                     postprocess and draw call. None records nothing and costs nothing
+    @param cache: DetectionCache that inference looks the input tensor up in before
+                  running the session. Not supported with models that run NMS themselves
     """
-    def __init__(self, path, class_names, conf_thres=0.7, iou_thres=0.5):
+    def __init__(self, path, class_names, conf_thres=0.7, iou_thres=0.5, use_io_binding=False,
+                 intra_op_num_threads=0, inter_op_num_threads=0, execution_mode='sequential',
+                 graph_optimization_level='all', optimized_model_path=None, max_candidates=None,
+                 input_size=None, profiler=None, cache=None):
         self.conf_threshold = conf_thres
         self.iou_threshold = iou_thres
+        self.use_io_binding = use_io_binding
+        self.intra_op_num_threads = intra_op_num_threads
+        self.inter_op_num_threads = inter_op_num_threads
+        self.execution_mode = execution_mode
+        self.graph_optimization_level = graph_optimization_level
+        self.optimized_model_path = optimized_model_path
+        self.max_candidates = max_candidates
+        self.input_size = input_size
+        self.profiler = profiler
+        self.cache = cache
         self.utils = Utils(class_names)
 
         # Initialize model
         self.initialize_model(path)
 
+        if self.cache is not None:
+            if self.embedded_nms:
+                raise ValueError("The detection cache stores candidates before NMS, "
+                                 "models with NMS in the graph only output final detections")
+            self.model_fingerprint = self.cache.fingerprint_file(path)
+
     def __call__(self, image):
         return self.detect_objects(image)
 
     def initialize_model(self, path):
-        self.session = onnxruntime.InferenceSession(path,
+        session_options = self.create_session_options()
+
+        if self.optimized_model_path is not None:
+            if self.is_optimized_model_current(path):
+                # Already optimized for this machine, so skip the optimization passes
+                path = self.optimized_model_file()
+                session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL
+            else:
+                session_options.optimized_model_filepath = self.optimized_model_file()
+
+        self.session = onnxruntime.InferenceSession(path, sess_options=session_options,
                                                     providers=onnxruntime.get_available_providers())
         # Get model info
         self.get_input_details()
         self.get_output_details()
-
+        self.allocate_buffers()
+        self.io_binding = self.bind_io() if self.use_io_binding else None
+
+
+    def create_session_options(self):
+        if self.execution_mode not in EXECUTION_MODES:
+            raise ValueError(f"Unknown execution mode '{self.execution_mode}', "
+                             f"expected one of {list(EXECUTION_MODES)}")
+        if self.graph_optimization_level not in GRAPH_OPTIMIZATION_LEVELS:
+            raise ValueError(f"Unknown graph optimization level '{self.graph_optimization_level}', "
+                             f"expected one of {list(GRAPH_OPTIMIZATION_LEVELS)}")
+
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = self.intra_op_num_threads
+        session_options.inter_op_num_threads = self.inter_op_num_threads
+        session_options.execution_mode = EXECUTION_MODES[self.execution_mode]
+        session_options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS[self.graph_optimization_level]
+        return session_options
+
+    def set_input_size(self, input_size):
+        """
+        Changes the inference resolution of a dynamic-shape model, e.g. to 320 for fast
+        previews at about a quarter of the cost of 640. Boxes are still returned in
+        image coordinates. Not thread safe, don't call it while a VideoPipeline runs.
+        @param input_size: int or (height, width), multiples of INPUT_SIZE_STRIDE
+        """
+        input_height, input_width = self.parse_input_size(input_size)
+        if (input_height, input_width) == (self.input_height, self.input_width):
+            return
+        if not self.dynamic_input_size:
+            raise ValueError(f"Model input size is fixed at {self.input_height}x{self.input_width}")
+
+        self.input_size = input_size
+        self.input_height, self.input_width = input_height, input_width
+        self.allocate_buffers()
+        if self.io_binding is not None:
+            self.io_binding = self.bind_io()
+
+    @staticmethod
+    def parse_input_size(input_size):
+        input_height, input_width = (input_size, input_size) if isinstance(input_size, int) else input_size
+        if input_height % INPUT_SIZE_STRIDE != 0 or input_width % INPUT_SIZE_STRIDE != 0:
+            raise ValueError(f"Input size {input_height}x{input_width} is not a multiple of {INPUT_SIZE_STRIDE}")
+        return input_height, input_width
+
+    def optimized_model_file(self):
+        """
+        optimized_model_path tagged with the optimization level and ORT version, a model
+        optimized at another level or by another ORT version gets its own file
+        """
+        root, ext = os.path.splitext(self.optimized_model_path)
+        return f"{root}.{self.graph_optimization_level}.ort{onnxruntime.__version__}{ext}"
+
+    def is_optimized_model_current(self, path):
+        # The saved model is hardware specific and goes stale when the source model changes
+        optimized_model_file = self.optimized_model_file()
+        return os.path.isfile(optimized_model_file) and \
+            os.path.getmtime(optimized_model_file) >= os.path.getmtime(path)
 
     def detect_objects(self, image):
+        if self.input_batch_size not in (None, 1):
+            # Fixed-batch models only take full batches, detect_batch pads the image to one
+            self.boxes, self.scores, self.class_ids = self.detect_batch([image])[0]
+            return self.boxes, self.scores, self.class_ids
+
         input_tensor = self.prepare_input(image)
 
         # Perform inference on the image
@@ -43,89 +182,391 @@ class YOLOv8:
 
         return self.boxes, self.scores, self.class_ids
 
-    def prepare_input(self, image):
+    def detect_batch(self, images, batch_size=None):
+        """
+        Detect objects in several images with one session run per batch
+        @param images: list of BGR images
+        @param batch_size: max images per session run. Fixed-batch models always
+                           use their own batch size; dynamic-batch models default
+                           to all images in one run
+        @return list of (boxes, scores, class_ids) tuples, one per image
+        """
+        if self.input_batch_size is not None:
+            batch_size = self.input_batch_size
+        elif batch_size is None:
+            batch_size = max(len(images), 1)
+
+        results = []
+        for start in range(0, len(images), batch_size):
+            chunk = images[start:start + batch_size]
+            input_tensor = self.prepare_batch(chunk)
+
+            outputs = self.inference(input_tensor)
+
+            # Split the batched output back into per image outputs, padded rows are dropped
+            for i, image in enumerate(chunk):
+                results.append(self.process_output(self.slice_outputs(outputs, i, i + 1), image.shape[:2]))
+
+        return results
+
+    def prepare_input(self, image, out=None):
+        """
+        Preprocess a BGR image into a float32 NCHW tensor, or a (1, H, W, 3) uint8
+        tensor of the frame itself for models that preprocess in the graph
+        @param image: BGR image
+        @param out: optional tensor from new_input_tensor to write into. Defaults to the
+                    detector's own buffer, which is overwritten by the next call
+        @return input tensor
+        """
+        start = time.perf_counter() if self.profiler is not None else None
         self.img_height, self.img_width = image.shape[:2]
 
-        input_img = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        if self.raw_input:
+            input_tensor = self.prepare_raw_input(image, out)
+        else:
+            input_tensor = self.prepare_scaled_input(image, out)
+
+        if self.profiler is not None:
+            self.profiler.record('preprocess', start)
+        return input_tensor
+
+    def prepare_raw_input(self, image, out=None):
+        if out is None:
+            # Frames are passed as they are, views are copied since ORT needs contiguous data
+            return np.ascontiguousarray(image)[np.newaxis]
+        np.copyto(out[0], image)
+        return out
+
+    def prepare_scaled_input(self, image, out=None):
+        if out is None:
+            out = self.input_buffer[:1]
+
+        # Resize input image into the reused buffer. Resizing works per channel, so
+        # resizing before the BGR to RGB swap gives the same pixels as swapping first
+        cv2.resize(image, (self.input_width, self.input_height), dst=self.resize_buffer)
 
-        # Resize input image
-        input_img = cv2.resize(input_img, (self.input_width, self.input_height))
+        # Swap BGR to RGB, HWC to CHW and scale pixel values to 0 to 1 in one pass per
+        # channel. The table holds float32(x / 255.0), same as the float64 divide did
+        for channel in range(3):
+            np.take(self.scale_table, self.resize_buffer[:, :, 2 - channel], out=out[0, channel], mode='clip')
 
-        # Scale input pixel values to 0 to 1
-        input_img = input_img / 255.0
-        input_img = input_img.transpose(2, 0, 1)
-        input_tensor = input_img[np.newaxis, :, :, :].astype(np.float32)
+        return out
+
+    def prepare_batch(self, images):
+        # Fixed-batch models need the full batch, so the last chunk is padded with
+        # whatever the buffer holds and those rows are dropped after inference
+        batch_size = self.input_batch_size or len(images)
+        input_tensor = self.get_input_buffer(batch_size, images[0].shape)
+        for i, image in enumerate(images):
+            self.prepare_input(image, out=input_tensor[i:i + 1])
 
         return input_tensor
 
+    def get_input_buffer(self, batch_size, image_shape=None):
+        # Grow the shared input buffer when a bigger batch comes in. Raw frame inputs
+        # also follow the frame size
+        shape = self.input_tensor_shape(batch_size, image_shape)
+        if self.input_buffer.shape[0] < batch_size or self.input_buffer.shape[1:] != shape[1:]:
+            self.input_buffer = self.new_input_tensor(batch_size, image_shape)
+            self.input_buffer.fill(0)
+
+        return self.input_buffer[:batch_size]
+
+    def input_tensor_shape(self, batch_size, image_shape=None):
+        if self.raw_input:
+            img_height, img_width = image_shape[:2] if image_shape is not None else self.input_buffer.shape[1:3]
+            return (batch_size, img_height, img_width, 3)
+        return (batch_size, 3, self.input_height, self.input_width)
+
+    def new_input_tensor(self, batch_size, image_shape=None):
+        """
+        Allocates an input tensor for batch_size images of image_shape, to fill with
+        prepare_input(image, out=tensor[i:i + 1])
+        """
+        return np.empty(self.input_tensor_shape(batch_size, image_shape), dtype=self.input_dtype)
+
+    def allocate_buffers(self):
+        self.resize_buffer = np.empty((self.input_height, self.input_width, 3), dtype=np.uint8)
+        # Raw frame inputs start at the model input size and follow the frames
+        self.input_buffer = np.zeros((self.input_batch_size or 1, self.input_height, self.input_width, 3)
+                                     if self.raw_input else
+                                     (self.input_batch_size or 1, 3, self.input_height, self.input_width),
+                                     dtype=self.input_dtype)
+        self.scale_table = (np.arange(256) / 255.0).astype(np.float32)
+
+    def bind_io(self):
+        io_binding = self.session.io_binding()
+        batch_size = self.input_batch_size or 1
+
+        # The session reads the input buffer in place, so refilling it is all a run needs
+        self.bind_input(io_binding, self.get_input_buffer(batch_size))
+        # Same for the thresholds of the NMS head, inference refreshes them before each run
+        for name, value in self.threshold_inputs.items():
+            io_binding.bind_ortvalue_input(name, onnxruntime.OrtValue.ortvalue_from_numpy(value))
+
+        # Preallocate outputs when every shape is static, otherwise let ORT allocate them.
+        # The detection count of the NMS head is not a batch size, so it stays dynamic
+        model_outputs = self.session.get_outputs()
+        output_shapes = []
+        for model_output in model_outputs:
+            shape = list(model_output.shape)
+            if not isinstance(shape[0], int):
+                shape[0] = batch_size
+            output_shapes.append(shape)
+        preallocate = not self.embedded_nms and \
+            all(isinstance(dim, int) for shape in output_shapes for dim in shape) and \
+            all(model_output.type in ONNX_TO_NUMPY_TYPES for model_output in model_outputs)
+
+        if not preallocate:
+            self.bound_outputs = None
+            self.bind_dynamic_outputs(io_binding)
+            return io_binding
+
+        self.bound_outputs = []
+        for model_output, shape in zip(model_outputs, output_shapes):
+            output_buffer = np.empty(shape, dtype=ONNX_TO_NUMPY_TYPES[model_output.type])
+            io_binding.bind_ortvalue_output(model_output.name, onnxruntime.OrtValue.ortvalue_from_numpy(output_buffer))
+            self.bound_outputs.append(output_buffer)
+
+        return io_binding
+
+    def bind_dynamic_outputs(self, io_binding):
+        # A run leaves its outputs bound with their shapes, so this is needed again
+        # before every run whose output shapes may differ
+        io_binding.clear_binding_outputs()
+        for output_name in self.output_names:
+            io_binding.bind_output(output_name, 'cpu')
+
+    def bind_input(self, io_binding, input_buffer):
+        self.bound_input = input_buffer
+        self.bound_input_value = onnxruntime.OrtValue.ortvalue_from_numpy(input_buffer)
+        io_binding.bind_ortvalue_input(self.input_names[0], self.bound_input_value)
+
+    def update_threshold_inputs(self):
+        # Thresholds can be changed on the detector at any time
+        if self.embedded_nms:
+            self.threshold_inputs[CONF_THRESHOLD_INPUT][...] = self.conf_threshold
+            self.threshold_inputs[IOU_THRESHOLD_INPUT][...] = self.iou_threshold
 
     def inference(self, input_tensor):
-        start = time.perf_counter()
-        outputs = self.session.run(self.output_names, {self.input_names[0]: input_tensor})
+        start = time.perf_counter() if self.profiler is not None else None
+        key = None
+        outputs = None
+        if self.cache is not None:
+            key = self.cache.make_key(self.model_fingerprint, input_tensor)
+            outputs = self.cache.get(key, self.conf_threshold)
+
+        if outputs is None:
+            outputs = self.run_session(input_tensor)
+            if key is not None:
+                self.cache.put(key, outputs)
+
+        if self.profiler is not None:
+            self.profiler.record('inference', start)
+        return outputs
 
-        # print(f"Inference time: {(time.perf_counter() - start)*1000:.2f} ms")
+    def run_session(self, input_tensor):
+        self.update_threshold_inputs()
+        if self.io_binding is not None and self.raw_input and input_tensor.shape != self.bound_input.shape and \
+                len(input_tensor) == len(self.bound_input):
+            # Raw frame inputs take the frame size, so bind a buffer of the new size
+            self.bind_input(self.io_binding, self.get_input_buffer(len(input_tensor), input_tensor.shape[1:3]))
+
+        if self.io_binding is not None and input_tensor.shape == self.bound_input.shape:
+            # Only copy when the tensor was not prepared in the bound buffer
+            if input_tensor.ctypes.data != self.bound_input.ctypes.data:
+                np.copyto(self.bound_input, input_tensor)
+            if self.bound_outputs is None:
+                self.bind_dynamic_outputs(self.io_binding)
+            self.session.run_with_iobinding(self.io_binding)
+
+            # Bound output buffers are reused, so they are overwritten by the next run
+            if self.bound_outputs is not None:
+                outputs = self.bound_outputs
+            else:
+                outputs = self.io_binding.copy_outputs_to_cpu()
+        else:
+            feeds = {self.input_names[0]: input_tensor, **self.threshold_inputs}
+            outputs = self.session.run(self.output_names, feeds)
         return outputs
 
-    def process_output(self, output):
-        predictions = np.squeeze(output[0]).T
+    def inference_batch(self, input_tensor):
+        """
+        Runs any number of prepared images, in chunks when the model has a fixed batch size
+        @param input_tensor: (N, 3, H, W) tensor
+        @return outputs with N rows each
+        """
+        batch_size = self.input_batch_size
+        if batch_size is None or len(input_tensor) == batch_size:
+            return self.inference(input_tensor)
+
+        chunk_outputs = []
+        for start in range(0, len(input_tensor), batch_size):
+            chunk = input_tensor[start:start + batch_size]
+            num_images = len(chunk)
+            if num_images < batch_size:
+                padded_chunk = np.zeros((batch_size,) + chunk.shape[1:], dtype=chunk.dtype)
+                padded_chunk[:num_images] = chunk
+                chunk = padded_chunk
+
+            # Copy out of the outputs, IO binding reuses them on the next run
+            chunk_outputs.append([output.copy() for output in
+                                  self.slice_outputs(self.inference(chunk), 0, num_images, first_index=start)])
+
+        return [np.concatenate(outputs) for outputs in zip(*chunk_outputs)]
+
+    def slice_outputs(self, outputs, start, stop, first_index=0):
+        """
+        Takes the outputs of images start to stop out of a batched run
+        @param first_index: batch index the first image gets in the result
+        @return outputs of stop - start images
+        """
+        if not self.embedded_nms:
+            return [output[start:stop] for output in outputs]
+
+        # Detection rows of all images come in one tensor, tagged with their batch index
+        detections = outputs[0]
+        image_detections = detections[(detections[:, 0] >= start) & (detections[:, 0] < stop)]
+        image_detections[:, 0] += first_index - start
+        return [image_detections]
+
+    def process_output(self, output, image_shape=None):
+        start = time.perf_counter() if self.profiler is not None else None
+
+        if self.embedded_nms:
+            detections = self.process_detections(output[0], image_shape)
+        else:
+            detections = self.decode_output(output, image_shape)
+
+        if self.profiler is not None:
+            self.profiler.record('postprocess', start)
+        return detections
+
+    def decode_output(self, output, image_shape=None):
+        # Rows are (x, y, w, h, class scores...) and columns are anchors. Each row is
+        # contiguous, so decode from the rows instead of transposing the whole tensor
+        predictions = output[0][0]
+        class_predictions = predictions[4:]
+
+        # Get the class with the highest confidence and its score in one pass
+        if len(class_predictions) == 1:
+            class_ids = None
+            scores = class_predictions[0]
+        else:
+            class_ids = np.argmax(class_predictions, axis=0)
+            scores = np.take_along_axis(class_predictions, class_ids[np.newaxis, :], axis=0)[0]
 
         # Filter out object confidence scores below threshold
-        scores = np.max(predictions[:, 4:], axis=1)
-        predictions = predictions[scores > self.conf_threshold, :]
-        scores = scores[scores > self.conf_threshold]
-
-        if len(scores) == 0:
+        candidates = np.flatnonzero(scores > self.conf_threshold)
+        if len(candidates) == 0:
             return [], [], []
 
-        # Get the class with the highest confidence
-        class_ids = np.argmax(predictions[:, 4:], axis=1)
+        # Cap the candidates going into NMS, keeping the anchor order NMS saw before
+        if self.max_candidates is not None and len(candidates) > self.max_candidates:
+            top_candidates = np.argpartition(scores[candidates], -self.max_candidates)[-self.max_candidates:]
+            candidates = np.sort(candidates[top_candidates])
+
+        scores = scores[candidates]
+        if class_ids is None:
+            class_ids = np.zeros(len(candidates), dtype=np.intp)
+        else:
+            class_ids = class_ids[candidates]
 
         # Get bounding boxes for each object
-        boxes = self.extract_boxes(predictions)
+        boxes = self.extract_boxes(predictions[:4, candidates].T, image_shape)
 
         # Apply non-maxima suppression to suppress weak, overlapping bounding boxes
         # indices = nms(boxes, scores, self.iou_threshold)
-        indices = self.utils.multiclass_nms(boxes, scores, class_ids, self.iou_threshold)
+        indices = self.utils.vectorized_multiclass_nms(boxes, scores, class_ids, self.iou_threshold)
 
         return boxes[indices], scores[indices], class_ids[indices]
 
-    def extract_boxes(self, predictions):
+    def process_detections(self, detections, image_shape=None):
+        # Rows are (batch, x1, y1, x2, y2, score, class) of one image, NMS already ran in the graph
+        if len(detections) == 0:
+            return [], [], []
+
+        boxes = self.rescale_boxes(detections[:, 1:5], image_shape)
+        return boxes, detections[:, 5], detections[:, 6].astype(np.intp)
+
+    def extract_boxes(self, predictions, image_shape=None):
         # Extract boxes from predictions
         boxes = predictions[:, :4]
 
         # Scale boxes to original image dimensions
-        boxes = self.rescale_boxes(boxes)
+        boxes = self.rescale_boxes(boxes, image_shape)
 
         # Convert boxes to xyxy format
         boxes = self.utils.xywh2xyxy(boxes)
 
         return boxes
 
-    def rescale_boxes(self, boxes):
+    def rescale_boxes(self, boxes, image_shape=None):
+        # Default to the size of the last image passed to prepare_input
+        img_height, img_width = image_shape if image_shape is not None else (self.img_height, self.img_width)
 
         # Rescale boxes to original image dimensions
         input_shape = np.array([self.input_width, self.input_height, self.input_width, self.input_height])
         boxes = np.divide(boxes, input_shape, dtype=np.float32)
-        boxes *= np.array([self.img_width, self.img_height, self.img_width, self.img_height])
+        boxes *= np.array([img_width, img_height, img_width, img_height])
         return boxes
 
-    def draw_detections(self, image, draw_scores=True, mask_alpha=0.4):
+    def draw_detections(self, image, draw_scores=True, mask_alpha=0.4, boxes=None, scores=None, class_ids=None,
+                        out=None):
+        """
+        Draws detections onto a copy of image, the ones of the last detect_objects call
+        unless boxes, scores and class_ids are given
+        @param out: buffer to draw into instead of a copy, image itself draws in place
+        """
+        start = time.perf_counter() if self.profiler is not None else None
+        if boxes is None:
+            boxes, scores, class_ids = self.boxes, self.scores, self.class_ids
 
-        return self.utils.draw_detections(image, self.boxes, self.scores,
-                                          self.class_ids, mask_alpha)
+        combined_img = self.utils.draw_detections(image, boxes, scores, class_ids, mask_alpha, out=out)
+
+        if self.profiler is not None:
+            self.profiler.record('draw', start)
+        return combined_img
 
     def get_input_details(self):
         model_inputs = self.session.get_inputs()
         self.input_names = [model_inputs[i].name for i in range(len(model_inputs))]
 
         self.input_shape = model_inputs[0].shape
-        self.input_height = self.input_shape[2]
-        self.input_width = self.input_shape[3]
+        # Dynamic batch exports report a symbolic name instead of a size
+        self.input_batch_size = self.input_shape[0] if isinstance(self.input_shape[0], int) else None
+
+        # Models with the preprocessing in the graph take raw frames and keep their
+        # network input size in the metadata
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.raw_input = metadata.get('preprocess') == RAW_BGR_PREPROCESS
+        if self.raw_input:
+            self.input_dtype = np.uint8
+            input_height, input_width = ast.literal_eval(metadata['imgsz'])
+        else:
+            self.input_dtype = np.float32
+            input_height, input_width = self.input_shape[2], self.input_shape[3]
+
+        # Dynamic-shape exports run at the requested size, the others at their own
+        self.dynamic_input_size = not isinstance(input_height, int) or not isinstance(input_width, int)
+        if self.dynamic_input_size:
+            input_height, input_width = self.parse_input_size(self.input_size or DEFAULT_INPUT_SIZE)
+        elif self.input_size is not None and self.parse_input_size(self.input_size) != (input_height, input_width):
+            raise ValueError(f"Model input size is fixed at {input_height}x{input_width}")
+        self.input_height, self.input_width = input_height, input_width
 
     def get_output_details(self):
         model_outputs = self.session.get_outputs()
         self.output_names = [model_outputs[i].name for i in range(len(model_outputs))]
 
+        # Models with the NMS head take the thresholds as inputs and output final detections
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.embedded_nms = metadata.get('postprocess') == EMBEDDED_NMS_POSTPROCESS
+        self.threshold_inputs = {}
+        if self.embedded_nms:
+            self.threshold_inputs = {CONF_THRESHOLD_INPUT: np.array(self.conf_threshold, dtype=np.float32),
+                                     IOU_THRESHOLD_INPUT: np.array(self.iou_threshold, dtype=np.float32)}
+
 
 if __name__ == '__main__':
     from imread_from_url import imread_from_url
@@ -0,0 +1,134 @@
+import hashlib
+import io
+import sqlite3
+import threading
+import numpy as np
+
+# Candidates whose best class score is below this are not stored, so cached frames can
+# be re-run with any conf_thres at or above it
+DEFAULT_SCORE_FLOOR = 0.05
+
+class DetectionCache:
+    """
+    Persistent cache of raw model outputs in a sqlite database, so re-running a video
+    with other thresholds or rendering skips the session run. Entries are keyed by a
+    hash of the model file and of the input tensor, which covers the frame as well as
+    the input size and preprocessing it went through. The value is the candidate set
+    before thresholding and NMS: the (4 + C) prediction columns of every anchor scoring
+    at least score_floor, so process_output gives the same detections as a fresh run
+    for any conf_thres >= score_floor and any iou_thres.
+    The least recently used entries are evicted once the stored candidates outgrow
+    max_size_mb. Models with NMS in the graph can't be cached, their outputs are
+    already thresholded.
+    @param path: database file, created when missing
+    @param max_size_mb: size of the stored candidates to keep
+    @param score_floor: lowest conf_thres the cached candidates can be re-run with
+    @param commit_interval: writes between commits, the rest is committed by close()
+    """
+    def __init__(self, path, max_size_mb=1024, score_floor=DEFAULT_SCORE_FLOOR, commit_interval=100):
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.score_floor = score_floor
+        self.commit_interval = commit_interval
+
+        # The pipeline runs inference on its own thread, the lock keeps the connection to one at a time
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS candidates ('
+                                'key BLOB PRIMARY KEY, score_floor REAL NOT NULL, data BLOB NOT NULL, '
+                                'size INTEGER NOT NULL, last_used INTEGER NOT NULL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS candidates_last_used ON candidates (last_used)')
+        self.connection.commit()
+        self.lock = threading.Lock()
+
+        self.size, self.clock = self.connection.execute(
+            'SELECT COALESCE(SUM(size), 0), COALESCE(MAX(last_used), 0) FROM candidates').fetchone()
+        self.pending_writes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def fingerprint_file(path):
+        """SHA-256 digest of the file at path, e.g. the model"""
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        return digest.digest()
+
+    @staticmethod
+    def make_key(fingerprint, input_tensor):
+        # SHA-256 runs on the CPU's SHA extensions where there are any, which makes
+        # it faster than blake2b and md5 on the megabytes of an input tensor
+        digest = hashlib.sha256(fingerprint)
+        digest.update(f'{input_tensor.shape}{input_tensor.dtype}'.encode())
+        digest.update(np.ascontiguousarray(input_tensor).data)
+        return digest.digest()
+
+    def get(self, key, conf_threshold):
+        """
+        @return the cached outputs of key, or None when there are none or they were
+                stored with a score floor above conf_threshold
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT score_floor, data FROM candidates WHERE key = ?', (key,)).fetchone()
+            if row is None or conf_threshold < row[0]:
+                self.misses += 1
+                return None
+
+            self.clock += 1
+            self.connection.execute('UPDATE candidates SET last_used = ? WHERE key = ?', (self.clock, key))
+            self.count_write()
+            self.hits += 1
+        return [np.load(io.BytesIO(row[1]), allow_pickle=False)]
+
+    def put(self, key, outputs):
+        """
+        Stores the candidates of outputs, the (N, 4 + C, A) predictions of one run
+        """
+        predictions = outputs[0]
+        keep = predictions[:, 4:].max(axis=1) >= self.score_floor
+        # Images of a batch keep different numbers of anchors, the rest is zero padded
+        candidates = np.zeros(predictions.shape[:2] + (keep.sum(axis=1).max(initial=0),), dtype=predictions.dtype)
+        for i, image_keep in enumerate(keep):
+            candidates[i, :, :image_keep.sum()] = predictions[i][:, image_keep]
+
+        buffer = io.BytesIO()
+        np.save(buffer, candidates, allow_pickle=False)
+        data = buffer.getvalue()
+
+        with self.lock:
+            old_size = self.connection.execute('SELECT size FROM candidates WHERE key = ?', (key,)).fetchone()
+            self.clock += 1
+            self.connection.execute('INSERT OR REPLACE INTO candidates VALUES (?, ?, ?, ?, ?)',
+                                    (key, self.score_floor, data, len(data), self.clock))
+            self.size += len(data) - (old_size[0] if old_size is not None else 0)
+            if self.size > self.max_size:
+                self.evict()
+            self.count_write()
+
+    def evict(self):
+        # Other processes may share the database, so start from its actual size
+        self.size = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM candidates').fetchone()[0]
+        while self.size > self.max_size:
+            oldest = self.connection.execute('SELECT key, size FROM candidates ORDER BY last_used LIMIT 100').fetchall()
+            if not oldest:
+                break
+            for key, size in oldest:
+                self.connection.execute('DELETE FROM candidates WHERE key = ?', (key,))
+                self.size -= size
+                if self.size <= self.max_size:
+                    break
+
+    def count_write(self):
+        self.pending_writes += 1
+        if self.pending_writes >= self.commit_interval:
+            self.connection.commit()
+            self.pending_writes = 0
+
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
@@ -0,0 +1,74 @@
+import numpy as np
+
+# Column name -> dtype of the saved detection file
+DETECTION_COLUMNS = {
+    'frame': np.int32,
+    'eye': np.int8,
+    'x1': np.float32,
+    'y1': np.float32,
+    'x2': np.float32,
+    'y2': np.float32,
+    'score': np.float32,
+    'class_id': np.int16,
+}
+
+class DetectionRecorder:
+    """
+    Collects per frame detections and saves them as one compressed .npz file with a
+    column per field, see DETECTION_COLUMNS. Eye is 0 for mono or left eye views and
+    1 for right eye views, with boxes in the coordinates of that view.
+    @param frame_offset: added to every frame index, for recording a segment of a video
+                         with the frame numbers of the whole video
+    """
+    def __init__(self, frame_offset=0):
+        self.columns = {name: [] for name in DETECTION_COLUMNS}
+        self.num_frames = 0
+        self.frame_offset = frame_offset
+
+    def add(self, frame_index, boxes, scores, class_ids, eye=0):
+        """Adds the detections of one view, add_views records a whole frame"""
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+
+        self.columns['frame'].append(np.full(len(boxes), self.frame_offset + frame_index, dtype=DETECTION_COLUMNS['frame']))
+        self.columns['eye'].append(np.full(len(boxes), eye, dtype=DETECTION_COLUMNS['eye']))
+        for i, name in enumerate(('x1', 'y1', 'x2', 'y2')):
+            self.columns[name].append(boxes[:, i])
+        self.columns['score'].append(np.asarray(scores, dtype=DETECTION_COLUMNS['score']))
+        self.columns['class_id'].append(np.asarray(class_ids, dtype=DETECTION_COLUMNS['class_id']))
+
+    def add_views(self, frame_index, detections):
+        """
+        Adds the detections of every view of a frame
+        @param detections: list of (boxes, scores, class_ids), one per eye
+        """
+        for eye, (boxes, scores, class_ids) in enumerate(detections):
+            self.add(frame_index, boxes, scores, class_ids, eye)
+        self.num_frames += 1
+
+    def to_columns(self):
+        return {name: np.concatenate(chunks) if chunks else np.empty(0, dtype=DETECTION_COLUMNS[name])
+                for name, chunks in self.columns.items()}
+
+    def save(self, path):
+        np.savez_compressed(path, num_frames=np.int64(self.num_frames), **self.to_columns())
+
+def load_detections(path):
+    """
+    Loads a file written by DetectionRecorder.save
+    @return dict of column name -> array, plus 'num_frames'
+    """
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
+
+def merge_detections(paths, path):
+    """
+    Concatenates detection files in the given order into one, e.g. the segments of a
+    video recorded with frame offsets
+    @return total number of frames
+    """
+    files = [load_detections(segment_path) for segment_path in paths]
+    num_frames = sum(int(data['num_frames']) for data in files)
+    columns = {name: np.concatenate([data[name] for data in files]) if files else np.empty(0, dtype=dtype)
+               for name, dtype in DETECTION_COLUMNS.items()}
+    np.savez_compressed(path, num_frames=np.int64(num_frames), **columns)
+    return num_frames
@@ -0,0 +1,16 @@
+# Names shared by the model edits in model_tools and the detector reading the edited
+# models. Kept free of imports, so loading the detector doesn't need the onnx package
+
+# metadata_props value of models that take raw BGR uint8 NHWC frames
+RAW_BGR_PREPROCESS = 'bgr_uint8_nhwc'
+
+# metadata_props value of models that run box decoding and NMS in the graph
+EMBEDDED_NMS_POSTPROCESS = 'nms'
+
+# Name and columns of the output of models with the NMS head
+DETECTIONS_OUTPUT = 'detections'
+DETECTION_FIELDS = ['batch', 'x1', 'y1', 'x2', 'y2', 'score', 'class']
+
+# Scalar float inputs of the NMS head
+CONF_THRESHOLD_INPUT = 'conf_threshold'
+IOU_THRESHOLD_INPUT = 'iou_threshold'
@@ -0,0 +1,190 @@
+import numpy as np
+import onnx
+from onnx import helper, numpy_helper, TensorProto
+from yolov8.model_metadata import RAW_BGR_PREPROCESS, EMBEDDED_NMS_POSTPROCESS, DETECTIONS_OUTPUT, \
+    DETECTION_FIELDS, CONF_THRESHOLD_INPUT, IOU_THRESHOLD_INPUT
+
+# Lowest opset the graph edits below are written against
+MIN_OPSET = 13
+
+def load_model(path):
+    model = onnx.load(path)
+    opset = get_opset(model)
+    if opset < MIN_OPSET:
+        raise ValueError(f"Model opset {opset} is too old, export it with opset {MIN_OPSET} or newer")
+    return model
+
+def get_opset(model):
+    return next(opset.version for opset in model.opset_import if opset.domain in ('', 'ai.onnx'))
+
+def get_metadata(model):
+    return {prop.key: prop.value for prop in model.metadata_props}
+
+def set_metadata(model, key, value):
+    for prop in model.metadata_props:
+        if prop.key == key:
+            prop.value = value
+            return
+    model.metadata_props.add(key=key, value=value)
+
+def get_input_size(model):
+    """
+    @return (height, width) of the NCHW image input
+    """
+    dims = model.graph.input[0].type.tensor_type.shape.dim
+    height, width = dims[2].dim_value, dims[3].dim_value
+    if height == 0 or width == 0:
+        raise ValueError("Model input height and width must be static")
+    return height, width
+
+def rename_input(graph, old_name, new_name):
+    """Points every consumer of old_name at new_name"""
+    for node in graph.node:
+        for i, name in enumerate(node.input):
+            if name == old_name:
+                node.input[i] = new_name
+    for graph_output in graph.output:
+        if graph_output.name == old_name:
+            graph_output.name = new_name
+
+def add_preprocessing(model):
+    """
+    Prepends what YOLOv8.prepare_input does to the graph, so the model takes raw BGR
+    uint8 frames of any size as an (N, H, W, 3) input and ORT can fuse the scaling into
+    the first convolution. The frame is cast to float before resizing, which keeps
+    the pixels within 0.7 of cv2.resize on uint8 where ORT's uint8 Resize rounds
+    differently, then swapped to RGB, transposed to NCHW and scaled to 0 to 1.
+    The input keeps its name and the model input size is saved as 'imgsz' metadata.
+    @return the same model, edited in place
+    """
+    graph = model.graph
+    if get_metadata(model).get('preprocess') == RAW_BGR_PREPROCESS:
+        raise ValueError("Model already has the preprocessing")
+
+    height, width = get_input_size(model)
+    model_input = graph.input[0]
+    input_name = model_input.name
+    preprocessed_name = input_name + '_preprocessed'
+    rename_input(graph, input_name, preprocessed_name)
+
+    batch_dim = model_input.type.tensor_type.shape.dim[0]
+    batch = batch_dim.dim_value if batch_dim.HasField('dim_value') else (batch_dim.dim_param or 'batch')
+    raw_input = helper.make_tensor_value_info(input_name, TensorProto.UINT8, [batch, 'height', 'width', 3])
+
+    graph.initializer.extend([
+        numpy_helper.from_array(np.array([0], dtype=np.int64), 'preprocess_batch_start'),
+        numpy_helper.from_array(np.array([1], dtype=np.int64), 'preprocess_batch_end'),
+        numpy_helper.from_array(np.array([height, width, 3], dtype=np.int64), 'preprocess_size'),
+        numpy_helper.from_array(np.array([2, 1, 0], dtype=np.int64), 'preprocess_bgr_to_rgb'),
+        numpy_helper.from_array(np.array(255.0, dtype=np.float32), 'preprocess_scale'),
+    ])
+    nodes = [
+        helper.make_node('Shape', [input_name], ['preprocess_input_shape']),
+        helper.make_node('Slice', ['preprocess_input_shape', 'preprocess_batch_start', 'preprocess_batch_end'],
+                         ['preprocess_batch']),
+        helper.make_node('Concat', ['preprocess_batch', 'preprocess_size'], ['preprocess_sizes'], axis=0),
+        helper.make_node('Cast', [input_name], ['preprocess_float'], to=TensorProto.FLOAT),
+        # half_pixel linear sampling is what cv2.INTER_LINEAR does
+        helper.make_node('Resize', ['preprocess_float', '', '', 'preprocess_sizes'], ['preprocess_resized'],
+                         mode='linear', coordinate_transformation_mode='half_pixel'),
+        helper.make_node('Gather', ['preprocess_resized', 'preprocess_bgr_to_rgb'], ['preprocess_rgb'], axis=3),
+        helper.make_node('Transpose', ['preprocess_rgb'], ['preprocess_nchw'], perm=[0, 3, 1, 2]),
+        helper.make_node('Div', ['preprocess_nchw', 'preprocess_scale'], [preprocessed_name]),
+    ]
+    for i, node in enumerate(nodes):
+        graph.node.insert(i, node)
+
+    graph.input.remove(model_input)
+    graph.input.insert(0, raw_input)
+
+    set_metadata(model, 'imgsz', str([height, width]))
+    set_metadata(model, 'preprocess', RAW_BGR_PREPROCESS)
+    onnx.checker.check_model(model)
+    return model
+
+def add_nms(model, max_detections=300):
+    """
+    Appends what YOLOv8.process_output does to the graph. The (N, 4 + C, A) output is
+    decoded to xyxy boxes, every anchor keeps only its best class like the argmax in
+    Python, and NonMaxSuppression runs per class. The only output left is
+    DETECTIONS_OUTPUT, one (batch, x1, y1, x2, y2, score, class) row per detection in
+    network input coordinates.
+    The confidence and IoU thresholds are graph inputs, so the detector passes its own
+    on every run and they can change without preparing the model again.
+    @param max_detections: max detections per class and image
+    @return the same model, edited in place
+    """
+    graph = model.graph
+    if get_metadata(model).get('postprocess') == EMBEDDED_NMS_POSTPROCESS:
+        raise ValueError("Model already has the NMS head")
+
+    model_output = graph.output[0]
+    num_channels = model_output.type.tensor_type.shape.dim[1].dim_value
+    if num_channels <= 4:
+        raise ValueError("Model output must have a static (4 + classes) channel dimension")
+    predictions = model_output.name
+    if model_output.type.tensor_type.elem_type != TensorProto.FLOAT:
+        graph.node.append(helper.make_node('Cast', [predictions], ['nms_predictions'], to=TensorProto.FLOAT))
+        predictions = 'nms_predictions'
+
+    graph.initializer.extend([
+        numpy_helper.from_array(np.array([0], dtype=np.int64), 'nms_zero'),
+        numpy_helper.from_array(np.array([1], dtype=np.int64), 'nms_one'),
+        numpy_helper.from_array(np.array([2], dtype=np.int64), 'nms_two'),
+        numpy_helper.from_array(np.array([4], dtype=np.int64), 'nms_four'),
+        numpy_helper.from_array(np.array([num_channels], dtype=np.int64), 'nms_num_channels'),
+        numpy_helper.from_array(np.array([0, 2], dtype=np.int64), 'nms_batch_and_box'),
+        numpy_helper.from_array(np.array([-1, 1], dtype=np.int64), 'nms_column'),
+        numpy_helper.from_array(np.array(0.5, dtype=np.float32), 'nms_half'),
+        numpy_helper.from_array(np.array(0.0, dtype=np.float32), 'nms_no_score'),
+        numpy_helper.from_array(np.array(max_detections, dtype=np.int64), 'nms_max_detections'),
+    ])
+    graph.input.extend([
+        helper.make_tensor_value_info(CONF_THRESHOLD_INPUT, TensorProto.FLOAT, []),
+        helper.make_tensor_value_info(IOU_THRESHOLD_INPUT, TensorProto.FLOAT, []),
+    ])
+
+    # ReduceMax takes its axes as an input from opset 18 on
+    if get_opset(model) >= 18:
+        reduce_max = helper.make_node('ReduceMax', ['nms_class_scores', 'nms_one'], ['nms_max_scores'], keepdims=1)
+    else:
+        reduce_max = helper.make_node('ReduceMax', ['nms_class_scores'], ['nms_max_scores'], axes=[1], keepdims=1)
+
+    graph.node.extend([
+        # (N, 4, A) xywh rows to (N, A, 4) xyxy boxes
+        helper.make_node('Slice', [predictions, 'nms_zero', 'nms_four', 'nms_one'], ['nms_xywh_rows']),
+        helper.make_node('Transpose', ['nms_xywh_rows'], ['nms_xywh'], perm=[0, 2, 1]),
+        helper.make_node('Slice', ['nms_xywh', 'nms_zero', 'nms_two', 'nms_two'], ['nms_xy']),
+        helper.make_node('Slice', ['nms_xywh', 'nms_two', 'nms_four', 'nms_two'], ['nms_wh']),
+        helper.make_node('Mul', ['nms_wh', 'nms_half'], ['nms_half_wh']),
+        helper.make_node('Sub', ['nms_xy', 'nms_half_wh'], ['nms_x1y1']),
+        helper.make_node('Add', ['nms_xy', 'nms_half_wh'], ['nms_x2y2']),
+        helper.make_node('Concat', ['nms_x1y1', 'nms_x2y2'], ['nms_boxes'], axis=2),
+        # (N, C, A) scores with everything but the best class of each anchor zeroed
+        helper.make_node('Slice', [predictions, 'nms_four', 'nms_num_channels', 'nms_one'], ['nms_class_scores']),
+        reduce_max,
+        helper.make_node('Equal', ['nms_class_scores', 'nms_max_scores'], ['nms_is_best']),
+        helper.make_node('Where', ['nms_is_best', 'nms_class_scores', 'nms_no_score'], ['nms_scores']),
+        helper.make_node('NonMaxSuppression',
+                         ['nms_boxes', 'nms_scores', 'nms_max_detections', IOU_THRESHOLD_INPUT, CONF_THRESHOLD_INPUT],
+                         ['nms_selected'], center_point_box=0),
+        # Selected (batch, class, anchor) triples to detection rows
+        helper.make_node('Gather', ['nms_selected', 'nms_batch_and_box'], ['nms_selected_boxes'], axis=1),
+        helper.make_node('GatherND', ['nms_boxes', 'nms_selected_boxes'], ['nms_detection_boxes']),
+        helper.make_node('GatherND', ['nms_scores', 'nms_selected'], ['nms_detection_scores']),
+        helper.make_node('Reshape', ['nms_detection_scores', 'nms_column'], ['nms_score_column']),
+        helper.make_node('Gather', ['nms_selected', 'nms_zero'], ['nms_batch_indices'], axis=1),
+        helper.make_node('Cast', ['nms_batch_indices'], ['nms_batch_column'], to=TensorProto.FLOAT),
+        helper.make_node('Gather', ['nms_selected', 'nms_one'], ['nms_class_indices'], axis=1),
+        helper.make_node('Cast', ['nms_class_indices'], ['nms_class_column'], to=TensorProto.FLOAT),
+        helper.make_node('Concat', ['nms_batch_column', 'nms_detection_boxes', 'nms_score_column',
+                                    'nms_class_column'], [DETECTIONS_OUTPUT], axis=1),
+    ])
+
+    del graph.output[:]
+    graph.output.append(helper.make_tensor_value_info(DETECTIONS_OUTPUT, TensorProto.FLOAT,
+                                                      ['num_detections', len(DETECTION_FIELDS)]))
+
+    set_metadata(model, 'postprocess', EMBEDDED_NMS_POSTPROCESS)
+    onnx.checker.check_model(model)
+    return model
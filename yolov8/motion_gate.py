@@ -0,0 +1,54 @@
+import cv2
+
+class MotionGate:
+    """
+    Skips the detector on frames that barely changed since the last frame it ran on and
+    reuses that frame's detections instead. The change is the mean absolute difference
+    of downscaled grayscale frames. Comparing against the last detected frame rather
+    than the previous one keeps slow drifts from going unnoticed.
+    @param detect: function(frame) returning detections, only needed when calling the gate
+    @param threshold: mean gray level difference (0-255) below which a frame counts as static
+    @param width: width of the downscaled frame the difference is computed on
+    """
+    def __init__(self, detect=None, threshold=2.0, width=160):
+        self.detect = detect
+        self.threshold = threshold
+        self.width = width
+
+        self.reference = None
+        self.detections = None
+        self.num_frames = 0
+        self.num_skipped = 0
+
+    def __call__(self, frame):
+        if self.should_detect(frame):
+            self.detections = self.detect(frame)
+        return self.detections
+
+    def should_detect(self, frame):
+        """
+        Returns False when frame is static enough to reuse the last detections. A True
+        result makes frame the new reference, so the detector must run on it.
+        """
+        self.num_frames += 1
+        small_frame = self.downscale(frame)
+
+        if self.reference is not None and self.motion_score(small_frame) < self.threshold:
+            self.num_skipped += 1
+            return False
+
+        self.reference = small_frame
+        return True
+
+    def motion_score(self, small_frame):
+        return cv2.norm(small_frame, self.reference, cv2.NORM_L1) / small_frame.size
+
+    def downscale(self, frame):
+        img_height, img_width = frame.shape[:2]
+        height = max(1, round(self.width * img_height / img_width))
+        small_frame = cv2.resize(frame, (self.width, height), interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(small_frame, cv2.COLOR_BGR2GRAY)
+
+    def skipped_ratio(self):
+        """Fraction of frames that reused detections"""
+        return self.num_skipped / self.num_frames if self.num_frames > 0 else 0.0
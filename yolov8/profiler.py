@@ -0,0 +1,77 @@
+import csv
+import json
+import time
+import numpy as np
+
+# Stages YOLOv8 records, in pipeline order
+STAGES = ('preprocess', 'inference', 'postprocess', 'draw')
+
+# Columns of stats(), also the CSV header
+STAT_COLUMNS = ('count', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms')
+
+class StageProfiler:
+    """
+    Records how long each stage of the detector takes per call. Every stage keeps its
+    last window timings in a ring buffer, so recording is an index write and the
+    percentiles follow recent behaviour. They are only computed when stats() is asked.
+    Each stage should be recorded from one thread, which is how VideoPipeline calls
+    the detector.
+    @param window: number of most recent calls per stage the stats cover
+    """
+    def __init__(self, window=1000):
+        self.window = window
+        self.samples = {stage: np.zeros(window) for stage in STAGES}
+        self.counts = dict.fromkeys(STAGES, 0)
+
+    def record(self, stage, start):
+        """
+        Records the time since start for stage
+        @param start: time.perf_counter() value taken when the stage started
+        """
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        if stage not in self.samples:
+            self.samples[stage] = np.zeros(self.window)
+            self.counts[stage] = 0
+        self.samples[stage][self.counts[stage] % self.window] = elapsed_ms
+        self.counts[stage] += 1
+
+    def stats(self):
+        """
+        @return dict of stage -> dict of STAT_COLUMNS over the last window calls, stages
+                that were never recorded are left out. count is the total number of calls
+        """
+        stats = {}
+        for stage, samples in self.samples.items():
+            count = self.counts[stage]
+            if count == 0:
+                continue
+            recent = samples[:min(count, self.window)]
+            p50, p95, p99 = np.percentile(recent, [50, 95, 99])
+            stats[stage] = {'count': count, 'mean_ms': float(recent.mean()), 'p50_ms': float(p50),
+                            'p95_ms': float(p95), 'p99_ms': float(p99), 'max_ms': float(recent.max())}
+        return stats
+
+    def reset(self):
+        for stage in self.counts:
+            self.counts[stage] = 0
+
+    def save(self, path):
+        """Writes stats() as CSV when path ends in .csv, as JSON otherwise"""
+        stats = self.stats()
+        if path.lower().endswith('.csv'):
+            with open(path, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(('stage',) + STAT_COLUMNS)
+                for stage, stage_stats in stats.items():
+                    writer.writerow([stage] + [stage_stats[column] for column in STAT_COLUMNS])
+        else:
+            with open(path, 'w') as f:
+                json.dump(stats, f, indent=4)
+
+    def summary(self):
+        """Stats as a table to print"""
+        lines = [f"{'stage':<12}" + "".join(f"{column:>10}" for column in STAT_COLUMNS)]
+        for stage, stage_stats in self.stats().items():
+            lines.append(f"{stage:<12}{stage_stats['count']:>10}" +
+                         "".join(f"{stage_stats[column]:>10.2f}" for column in STAT_COLUMNS[1:]))
+        return "\n".join(lines)
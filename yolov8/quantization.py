@@ -0,0 +1,181 @@
+import os
+import tempfile
+import time
+import cv2
+import numpy as np
+import onnx
+from onnxruntime.quantization import CalibrationDataReader, CalibrationMethod, QuantFormat, QuantType, \
+    quantize_static
+from onnxruntime.quantization.shape_inference import quant_pre_process
+
+from yolov8.model_metadata import DETECTIONS_OUTPUT
+from yolov8.model_tools import set_metadata
+
+# metadata_props value of models written by quantize_model
+INT8_QDQ_QUANTIZATION = 'int8_qdq'
+
+CALIBRATION_METHODS = {
+    'minmax': CalibrationMethod.MinMax,
+    'entropy': CalibrationMethod.Entropy,
+    'percentile': CalibrationMethod.Percentile,
+}
+
+class FrameCalibrationReader(CalibrationDataReader):
+    """
+    Feeds frames, e.g. the ones VideoUtils.getFrameFromVideo extracts, to the INT8
+    calibration. They are preprocessed by the FP32 detector, so calibration sees
+    exactly the tensors the model gets at inference time.
+    @param detector: YOLOv8 detector of the model being quantized
+    @param image_paths: calibration images
+    """
+    def __init__(self, detector, image_paths):
+        self.detector = detector
+        self.image_paths = image_paths
+        self.batch_size = detector.input_batch_size or 1
+        self.position = 0
+
+    def get_next(self):
+        paths = self.image_paths[self.position:self.position + self.batch_size]
+        if not paths:
+            return None
+        self.position += self.batch_size
+
+        # prepare_batch pads the last batch of fixed batch models
+        input_tensor = self.detector.prepare_batch([cv2.imread(path) for path in paths])
+        return {self.detector.input_names[0]: input_tensor.copy(), **self.detector.threshold_inputs}
+
+    def rewind(self):
+        self.position = 0
+
+def quantize_model(model_path, output_path, calibration_reader, per_channel=True, calibrate_method='minmax'):
+    """
+    Writes a QDQ INT8 copy of model_path calibrated on calibration_reader. Weights are
+    signed and activations unsigned 8 bit, which the ORT CPU kernels run fastest.
+    The nodes writing the predictions stay float, see get_output_nodes.
+    The metadata of the source model is kept and tagged with 'quantization'.
+    @param calibrate_method: 'minmax', 'entropy' or 'percentile'
+    """
+    if calibrate_method not in CALIBRATION_METHODS:
+        raise ValueError(f"Unknown calibration method '{calibrate_method}', "
+                         f"expected one of {list(CALIBRATION_METHODS)}")
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # Shape inference and graph cleanup first, as ORT recommends before quantizing
+        preprocessed_path = os.path.join(temp_dir, 'preprocessed.onnx')
+        quant_pre_process(model_path, preprocessed_path)
+
+        # Nodes can only be excluded by name
+        model = onnx.load(preprocessed_path)
+        for i, node in enumerate(model.graph.node):
+            if not node.name:
+                node.name = f"{node.op_type}_{i}"
+        onnx.save(model, preprocessed_path)
+
+        quantize_static(preprocessed_path, output_path, calibration_reader,
+                        quant_format=QuantFormat.QDQ,
+                        nodes_to_exclude=get_output_nodes(model),
+                        per_channel=per_channel,
+                        activation_type=QuantType.QUInt8,
+                        weight_type=QuantType.QInt8,
+                        calibrate_method=CALIBRATION_METHODS[calibrate_method])
+
+    model = onnx.load(output_path)
+    for prop in onnx.load(model_path, load_external_data=False).metadata_props:
+        set_metadata(model, prop.key, prop.value)
+    set_metadata(model, 'quantization', INT8_QDQ_QUANTIZATION)
+    onnx.save(model, output_path)
+
+def get_output_nodes(model):
+    """
+    Names of the nodes that write the (4 + C, A) predictions, plus the NMS head. The
+    predictions hold pixel coordinates and 0 to 1 scores in one tensor, so a single
+    8 bit scale for it would leave the scores with only a few levels.
+    """
+    graph = model.graph
+    head_nodes = [node for node in graph.node
+                  if any(name.startswith('nms_') or name == DETECTIONS_OUTPUT for name in node.output)]
+    head_outputs = {name for node in head_nodes for name in node.output}
+
+    # Outputs of the network itself, the NMS head reads them when there is one
+    if head_nodes:
+        prediction_names = {name for node in head_nodes for name in node.input
+                            if name and name not in head_outputs and not name.startswith('nms_')}
+    else:
+        prediction_names = {graph_output.name for graph_output in graph.output}
+    prediction_nodes = [node for node in graph.node if prediction_names.intersection(node.output)]
+    return [node.name for node in prediction_nodes + head_nodes]
+
+def compare_detectors(reference, candidate, images, match_iou=0.5, repeats=3):
+    """
+    Runs two detectors on the same images and reports how much faster and how
+    different the candidate is, with the reference detections taken as ground truth
+    @param reference: YOLOv8 detector, e.g. the FP32 model
+    @param candidate: YOLOv8 detector, e.g. the INT8 model
+    @param images: held-out BGR images
+    @param match_iou: min IoU of two detections of the same class to count as the same
+    @param repeats: timed inference runs per image, the median is used
+    @return dict of latencies in ms, speedup and agreement stats
+    """
+    latencies = {'reference': [], 'candidate': []}
+    num_reference = num_candidate = num_matched = 0
+    score_deltas = []
+    matched_ious = []
+
+    for image in images:
+        for name, detector in (('reference', reference), ('candidate', candidate)):
+            input_tensor = detector.prepare_batch([image]).copy()
+            times = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                detector.inference(input_tensor)
+                times.append((time.perf_counter() - start) * 1000)
+            latencies[name].append(np.median(times))
+
+        reference_boxes, reference_scores, reference_class_ids = reference.detect_batch([image])[0]
+        candidate_boxes, candidate_scores, candidate_class_ids = candidate.detect_batch([image])[0]
+        num_reference += len(reference_boxes)
+        num_candidate += len(candidate_boxes)
+        for reference_id, candidate_id, iou in match_detections(reference.utils, reference_boxes, reference_class_ids,
+                                                                candidate_boxes, candidate_class_ids, match_iou):
+            num_matched += 1
+            matched_ious.append(iou)
+            score_deltas.append(abs(float(candidate_scores[candidate_id]) - float(reference_scores[reference_id])))
+
+    reference_ms = float(np.median(latencies['reference']))
+    candidate_ms = float(np.median(latencies['candidate']))
+    return {
+        'images': len(images),
+        'reference_ms': reference_ms,
+        'candidate_ms': candidate_ms,
+        'speedup': reference_ms / candidate_ms if candidate_ms > 0 else 0.0,
+        'reference_detections': num_reference,
+        'candidate_detections': num_candidate,
+        # Share of reference detections the candidate found and vice versa
+        'recall': num_matched / num_reference if num_reference > 0 else 1.0,
+        'precision': num_matched / num_candidate if num_candidate > 0 else 1.0,
+        'mean_matched_iou': float(np.mean(matched_ious)) if matched_ious else 0.0,
+        'mean_score_delta': float(np.mean(score_deltas)) if score_deltas else 0.0,
+    }
+
+def match_detections(utils, boxes_a, class_ids_a, boxes_b, class_ids_b, match_iou):
+    """
+    Greedy one to one matching of two detection sets by IoU within each class
+    @return list of (index in a, index in b, iou)
+    """
+    if len(boxes_a) == 0 or len(boxes_b) == 0:
+        return []
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ious = np.nan_to_num(utils.compute_iou_matrix(np.asarray(boxes_a), np.asarray(boxes_b)), nan=0.0)
+    ious[np.asarray(class_ids_a)[:, np.newaxis] != np.asarray(class_ids_b)[np.newaxis, :]] = 0
+
+    matches = []
+    while True:
+        index_a, index_b = np.unravel_index(np.argmax(ious), ious.shape)
+        iou = ious[index_a, index_b]
+        if iou < match_iou:
+            break
+        matches.append((index_a, index_b, float(iou)))
+        ious[index_a, :] = 0
+        ious[:, index_b] = 0
+    return matches
@@ -0,0 +1,64 @@
+import time
+
+class LatencyBudgetPolicy:
+    """
+    Picks the inference resolution of a dynamic-shape detector from the measured
+    latency of the detect function it wraps. It steps down to the next smaller size
+    while the smoothed latency is over budget, and back up once the larger size is
+    expected to fit, taking the cost to grow with the pixel count.
+    Called like the detect function it wraps, so the output format stays the same.
+    @param detect: function(frame) returning detections, run by detector
+    @param detector: YOLOv8 detector of a dynamic-shape model
+    @param budget_ms: target latency of one detect call in milliseconds
+    @param sizes: input sizes to choose from
+    @param smoothing: weight of the previous latency in the moving average
+    @param patience: frames to stay at a size before changing it again
+    """
+    def __init__(self, detect, detector, budget_ms, sizes=(320, 480, 640), smoothing=0.8, patience=30):
+        if not detector.dynamic_input_size:
+            raise ValueError(f"Model input size is fixed at {detector.input_height}x{detector.input_width}, "
+                             "a latency budget needs a dynamic-shape model")
+        self.detect = detect
+        self.detector = detector
+        self.budget_ms = budget_ms
+        self.sizes = sorted(sizes)
+        self.smoothing = smoothing
+        self.patience = patience
+
+        # Start from the largest size and step down if it is too slow
+        self.index = len(self.sizes) - 1
+        self.detector.set_input_size(self.sizes[self.index])
+        self.latency_ms = None
+        self.frames_at_size = 0
+        self.frames_per_size = {size: 0 for size in self.sizes}
+
+    def __call__(self, frame):
+        start = time.perf_counter()
+        detections = self.detect(frame)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+        if self.latency_ms is None:
+            self.latency_ms = elapsed_ms
+        else:
+            self.latency_ms = self.smoothing * self.latency_ms + (1 - self.smoothing) * elapsed_ms
+        self.frames_at_size += 1
+        self.frames_per_size[self.sizes[self.index]] += 1
+
+        if self.frames_at_size >= self.patience:
+            self.adjust()
+        return detections
+
+    def adjust(self):
+        if self.latency_ms > self.budget_ms:
+            if self.index > 0:
+                self.switch(self.index - 1)
+        elif self.index < len(self.sizes) - 1:
+            expected_ms = self.latency_ms * (self.sizes[self.index + 1] / self.sizes[self.index]) ** 2
+            if expected_ms < self.budget_ms:
+                self.switch(self.index + 1)
+
+    def switch(self, index):
+        self.index = index
+        self.detector.set_input_size(self.sizes[index])
+        self.latency_ms = None
+        self.frames_at_size = 0
@@ -0,0 +1,146 @@
+import numpy as np
+
+# Confidence factor of a track seen once, its velocity is still unknown
+NEW_TRACK_CONFIDENCE = 0.5
+
+class BoxTracker:
+    """
+    Carries detections of one view across frames with a constant velocity model.
+    Detector results are associated to the existing tracks by IoU, which gives each
+    track a velocity, and predict() moves every track by its velocity. A track's
+    confidence is the IoU between its prediction and the detection it was matched to,
+    decayed on every predicted frame. Detection scores are passed through unchanged.
+    @param utils: Utils used for the IoU computation
+    @param iou_threshold: min IoU between a predicted track and a detection to match them
+    @param decay: confidence multiplier per predicted frame
+    @param velocity_smoothing: weight of the previous velocity when a track is matched again
+    """
+    def __init__(self, utils, iou_threshold=0.3, decay=0.9, velocity_smoothing=0.5):
+        self.utils = utils
+        self.iou_threshold = iou_threshold
+        self.decay = decay
+        self.velocity_smoothing = velocity_smoothing
+
+        self.boxes = np.empty((0, 4), dtype=np.float32)
+        self.detected_boxes = np.empty((0, 4), dtype=np.float32)
+        self.velocities = np.empty((0, 4), dtype=np.float32)
+        self.scores = np.empty(0, dtype=np.float32)
+        self.class_ids = np.empty(0, dtype=np.intp)
+        self.confidences = np.empty(0, dtype=np.float32)
+        self.frames_since_detection = 0
+
+    def update(self, boxes, scores, class_ids):
+        """
+        Replaces the tracks with new detector results
+        @return the detections as arrays
+        """
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        scores = np.asarray(scores, dtype=np.float32)
+        class_ids = np.asarray(class_ids, dtype=np.intp)
+
+        # Compare against where the tracks would be on this frame
+        elapsed_frames = self.frames_since_detection + 1
+        predicted_boxes = self.boxes + self.velocities
+
+        velocities = np.zeros_like(boxes)
+        confidences = np.full(len(boxes), NEW_TRACK_CONFIDENCE, dtype=np.float32)
+        for track_id, detection_id, iou in self.match(predicted_boxes, boxes, class_ids):
+            measured_velocity = (boxes[detection_id] - self.detected_boxes[track_id]) / elapsed_frames
+            velocities[detection_id] = self.velocity_smoothing * self.velocities[track_id] + \
+                (1 - self.velocity_smoothing) * measured_velocity
+            # A prediction that landed close to the detection means the motion model holds
+            confidences[detection_id] = iou
+
+        self.boxes = boxes.copy()
+        self.detected_boxes = boxes.copy()
+        self.velocities = velocities
+        self.scores = scores
+        self.class_ids = class_ids
+        self.confidences = confidences
+        self.frames_since_detection = 0
+        return boxes, scores, class_ids
+
+    def predict(self):
+        """
+        Moves every track one frame ahead
+        @return predicted boxes, scores, class_ids
+        """
+        self.frames_since_detection += 1
+        self.boxes = self.boxes + self.velocities
+        self.confidences = self.confidences * self.decay
+        return self.boxes.copy(), self.scores.copy(), self.class_ids.copy()
+
+    def confidence(self):
+        # Lowest track confidence, an empty view has nothing that can drift
+        return float(self.confidences.min()) if len(self.confidences) > 0 else 1.0
+
+    def match(self, track_boxes, boxes, class_ids):
+        """Greedy IoU association of tracks and detections of the same class"""
+        if len(track_boxes) == 0 or len(boxes) == 0:
+            return []
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ious = self.utils.compute_iou_matrix(track_boxes, boxes)
+        ious = np.nan_to_num(ious, nan=0.0)
+        ious[self.class_ids[:, np.newaxis] != class_ids[np.newaxis, :]] = 0
+
+        matches = []
+        while True:
+            track_id, detection_id = np.unravel_index(np.argmax(ious), ious.shape)
+            iou = ious[track_id, detection_id]
+            if iou < self.iou_threshold:
+                break
+            matches.append((track_id, detection_id, iou))
+            ious[track_id, :] = 0
+            ious[:, detection_id] = 0
+        return matches
+
+class KeyframeTracker:
+    """
+    Runs the detector every interval frames, or sooner when the tracking confidence
+    drops below min_confidence, and predicts the boxes of the frames in between.
+    Called like the detect function it wraps, so the output format stays the same.
+    @param detect: function(frame) returning a list of (boxes, scores, class_ids), one per view
+    @param utils: Utils used for the IoU computation
+    @param interval: max frames per detector run, 1 runs the detector on every frame
+    @param min_confidence: run the detector as soon as a track would fall below this
+    @param decay: tracking confidence multiplier per predicted frame
+    @param iou_threshold: min IoU between a predicted track and a detection to match them
+    """
+    def __init__(self, detect, utils, interval=5, min_confidence=0.3, decay=0.9, iou_threshold=0.3):
+        self.detect = detect
+        self.utils = utils
+        self.interval = interval
+        self.min_confidence = min_confidence
+        self.decay = decay
+        self.iou_threshold = iou_threshold
+
+        self.trackers = None
+        self.frames_until_detection = 0
+        self.num_frames = 0
+        self.num_detections = 0
+
+    def __call__(self, frame):
+        self.num_frames += 1
+
+        if self.needs_detection():
+            detections = self.detect(frame)
+            if self.trackers is None or len(self.trackers) != len(detections):
+                self.trackers = [BoxTracker(self.utils, self.iou_threshold, self.decay) for _ in detections]
+
+            self.frames_until_detection = self.interval - 1
+            self.num_detections += 1
+            return [tracker.update(*view_detections) for tracker, view_detections in zip(self.trackers, detections)]
+
+        self.frames_until_detection -= 1
+        return [tracker.predict() for tracker in self.trackers]
+
+    def needs_detection(self):
+        if self.trackers is None or self.frames_until_detection <= 0:
+            return True
+        # Confidence the tracks would have after predicting this frame
+        return min(tracker.confidence() for tracker in self.trackers) * self.decay < self.min_confidence
+
+    def detection_ratio(self):
+        """Fraction of frames the detector ran on"""
+        return self.num_detections / self.num_frames if self.num_frames > 0 else 0.0
@@ -20,6 +20,8 @@ class Utils:
         self.class_names = _class_names
         rng = np.random.default_rng(3)
         self.colors = rng.uniform(0, 255, size=(len(_class_names), 3))
+        # cv2.getTextSize results by (text, font size, thickness)
+        self.text_sizes = {}
         
         pass
 
@@ -59,6 +61,171 @@ class Utils:
 
         return keep_boxes
 
+    def vectorized_multiclass_nms(self, boxes, scores, class_ids, iou_threshold, probe_steps=32, step_pairs=500,
+                                  box_pairs=80):
+        """
+        Same keep set and order as multiclass_nms, without its per box loop over IoUs
+        where that loop is slow. Each class is sorted with the same argsort as nms, so
+        tied scores are visited in the same order.
+        The loop is fast when every kept box suppresses many others, e.g. a few dense
+        clusters, and slow when it keeps hundreds of boxes. So each class starts with
+        probe_steps steps of nms, which finish the dense cases, and the rest may go to the
+        pair path: IoUs are computed just for the pairs a sweep over x finds, and the
+        greedy pass walks that pair list in score order. The pair path is taken when it
+        costs less than the remaining nms steps, counted in compared pairs. Measured, an
+        nms step costs about step_pairs + remaining / 4 pairs and the greedy pass
+        box_pairs per box, the number of steps is estimated by count_box_cells.
+        Classes with boxes of no area stay on nms, it counts their NaN IoUs as overlaps.
+        @param probe_steps: nms steps run before choosing between nms and the pair path
+        @param step_pairs: fixed cost of an nms step in compared pairs
+        @param box_pairs: cost of the greedy pass per box in compared pairs
+        @return array of kept indices, grouped by class id and sorted by score within a class
+        """
+        boxes = np.asarray(boxes)
+        scores = np.asarray(scores)
+        class_ids = np.asarray(class_ids)
+
+        keep_boxes = []
+        for class_id in np.unique(class_ids):
+            class_indices = np.where(class_ids == class_id)[0]
+            class_scores = scores[class_indices]
+
+            # Same visiting order as nms
+            order = np.argsort(class_scores)[::-1]
+            sorted_boxes = boxes[class_indices[order], :]
+            class_keep_boxes, remaining = self.nms_steps(sorted_boxes, np.arange(len(order)), iou_threshold,
+                                                         probe_steps)
+
+            pairs = None
+            if remaining.size > probe_steps and iou_threshold > 0:
+                remaining_boxes = sorted_boxes[remaining]
+                if np.all(remaining_boxes[:, 2:] > remaining_boxes[:, :2]):
+                    steps = self.count_box_cells(remaining_boxes)
+                    if steps > probe_steps:
+                        max_pairs = steps * (step_pairs + remaining.size / 4) - box_pairs * remaining.size
+                        pairs = self.overlapping_pairs(remaining_boxes, iou_threshold, max_pairs)
+
+            if pairs is None:
+                class_keep_boxes += self.nms_steps(sorted_boxes, remaining, iou_threshold)[0]
+            else:
+                class_keep_boxes += remaining[self.sorted_nms(remaining_boxes, pairs, iou_threshold)].tolist()
+            keep_boxes.append(class_indices[order[np.array(class_keep_boxes, dtype=np.intp)]])
+
+        if not keep_boxes:
+            return np.array([], dtype=np.intp)
+        return np.concatenate(keep_boxes)
+
+    def nms_steps(self, boxes, remaining, iou_threshold, max_steps=None):
+        """
+        The loop of nms on boxes sorted by descending score, stopped after max_steps kept boxes
+        @param remaining: ascending indices of the boxes not yet kept or suppressed
+        @return kept indices, indices still remaining
+        """
+        keep_boxes = []
+        while remaining.size > 0 and (max_steps is None or len(keep_boxes) < max_steps):
+            box_id = remaining[0]
+            keep_boxes.append(box_id)
+            ious = self.compute_iou(boxes[box_id, :], boxes[remaining[1:], :])
+            remaining = remaining[np.where(ious < iou_threshold)[0] + 1]
+        return keep_boxes, remaining
+
+    def count_box_cells(self, boxes):
+        """
+        Estimate of the boxes nms keeps out of boxes: the number of distinct cells of
+        position and size they fall into, cells being about as large as their boxes.
+        Boxes in one cell mostly suppress each other.
+        @param boxes: boxes with x2 > x1 and y2 > y1
+        """
+        boxes = boxes.astype(np.float64)
+        sizes = boxes[:, 2:] - boxes[:, :2]
+        size_steps = np.round(2 * np.log2(sizes))
+        positions = np.floor((boxes[:, :2] + boxes[:, 2:]) / 2 / 2 ** (size_steps / 2))
+        # One int64 key per cell, 8 bits per size step and 24 per position
+        keys = np.clip(size_steps + 128, 0, 255).astype(np.int64)
+        keys = (keys[:, 0] << 8 | keys[:, 1]) << 48
+        positions = np.clip(positions + (1 << 23), 0, (1 << 24) - 1).astype(np.int64)
+        keys |= positions[:, 0] << 24 | positions[:, 1]
+        return len(np.unique(keys))
+
+    def overlapping_pairs(self, boxes, iou_threshold, max_pairs, block_size=64):
+        """
+        Pairs of boxes that may reach iou_threshold. The intersection of such a pair spans
+        at least iou_threshold of the width and of the height of both boxes, so after
+        sorting by x1 a box only needs to be paired with the boxes starting within its
+        first 1 - iou_threshold of width. Blocks of block_size boxes in x order are
+        compared against the window of boxes their members can pair with. The bound gets
+        a small margin so float rounding in the IoU can't drop a pair nms would suppress.
+        @param boxes: boxes with x2 > x1 and y2 > y1
+        @return (first, second) index arrays with first < second, None if the windows
+                hold more than max_pairs pairs
+        """
+        min_overlap = iou_threshold * (1 - 1e-4)
+        x_order = np.argsort(boxes[:, 0], kind='stable')
+        x1, y1, x2, y2 = (boxes[x_order, i].astype(np.float64) for i in range(4))
+        widths, heights = x2 - x1, y2 - y1
+
+        # Boxes past ends[i] start too far right to overlap box i enough
+        ends = np.searchsorted(x1, x2 - min_overlap * widths, side='right')
+        starts = np.arange(0, len(boxes), block_size)
+        block_ends = np.maximum.reduceat(ends, starts)
+        block_sizes = np.minimum(starts + block_size, len(boxes)) - starts
+        if int(np.sum(block_sizes * np.maximum(block_ends - starts - 1, 0))) > max_pairs:
+            return None
+
+        first, second = [], []
+        for start, end in zip(starts.tolist(), block_ends.tolist()):
+            if end <= start + 1:
+                continue
+            rows = slice(start, min(start + block_size, len(boxes)))
+            columns = slice(start + 1, end)
+            overlap_x = np.minimum(x2[rows, np.newaxis], x2[columns]) - np.maximum(x1[rows, np.newaxis], x1[columns])
+            overlap_y = np.minimum(y2[rows, np.newaxis], y2[columns]) - np.maximum(y1[rows, np.newaxis], y1[columns])
+            candidates = (overlap_x >= min_overlap * np.maximum(widths[rows, np.newaxis], widths[columns])) & \
+                         (overlap_y >= min_overlap * np.maximum(heights[rows, np.newaxis], heights[columns]))
+            # Each pair once, from the box that comes first in x order
+            candidates &= np.arange(candidates.shape[1]) >= np.arange(candidates.shape[0])[:, np.newaxis]
+            row_ids, column_ids = np.nonzero(candidates)
+            first.append(row_ids + start)
+            second.append(column_ids + start + 1)
+
+        if not first:
+            return np.array([], dtype=np.intp), np.array([], dtype=np.intp)
+        a, b = x_order[np.concatenate(first)], x_order[np.concatenate(second)]
+        return np.minimum(a, b), np.maximum(a, b)
+
+    def sorted_nms(self, boxes, pairs, iou_threshold):
+        """
+        Greedy NMS of boxes sorted by descending score, given every pair that can overlap
+        @return kept indices in score order
+        """
+        first, second = pairs
+        x1, y1, x2, y2 = (np.ascontiguousarray(boxes[:, i]) for i in range(4))
+        areas = (x2 - x1) * (y2 - y1)
+
+        # Same arithmetic as compute_iou, with the higher scoring box as box
+        xmin = np.maximum(x1[first], x1[second])
+        ymin = np.maximum(y1[first], y1[second])
+        xmax = np.minimum(x2[first], x2[second])
+        ymax = np.minimum(y2[first], y2[second])
+        intersection_area = np.maximum(0, xmax - xmin) * np.maximum(0, ymax - ymin)
+        ious = intersection_area / (areas[first] + areas[second] - intersection_area)
+
+        # Boxes each box suppresses once it is kept, grouped by the suppressing box
+        suppressing = ~(ious < iou_threshold)
+        first, second = first[suppressing], second[suppressing]
+        grouped = np.argsort(first, kind='stable')
+        suppressed_boxes = second[grouped]
+        bounds = np.searchsorted(first[grouped], np.arange(len(boxes) + 1)).tolist()
+
+        suppressed = np.zeros(len(boxes), dtype=bool)
+        keep_boxes = []
+        for box_id in range(len(boxes)):
+            if suppressed[box_id]:
+                continue
+            keep_boxes.append(box_id)
+            suppressed[suppressed_boxes[bounds[box_id]:bounds[box_id + 1]]] = True
+        return np.array(keep_boxes, dtype=np.intp)
+
     def compute_iou(self, box, boxes):
         # Compute xmin, ymin, xmax, ymax for both boxes
         xmin = np.maximum(box[0], boxes[:, 0])
@@ -79,6 +246,24 @@ class Utils:
 
         return iou
 
+    def compute_iou_matrix(self, boxes_a, boxes_b):
+        # Same arithmetic as compute_iou, for every pair of boxes_a and boxes_b
+        xmin = np.maximum(boxes_a[:, np.newaxis, 0], boxes_b[np.newaxis, :, 0])
+        ymin = np.maximum(boxes_a[:, np.newaxis, 1], boxes_b[np.newaxis, :, 1])
+        xmax = np.minimum(boxes_a[:, np.newaxis, 2], boxes_b[np.newaxis, :, 2])
+        ymax = np.minimum(boxes_a[:, np.newaxis, 3], boxes_b[np.newaxis, :, 3])
+
+        # Compute intersection area
+        intersection_area = np.maximum(0, xmax - xmin) * np.maximum(0, ymax - ymin)
+
+        # Compute union area
+        boxes_a_area = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 3] - boxes_a[:, 1])
+        boxes_b_area = (boxes_b[:, 2] - boxes_b[:, 0]) * (boxes_b[:, 3] - boxes_b[:, 1])
+        union_area = boxes_a_area[:, np.newaxis] + boxes_b_area[np.newaxis, :] - intersection_area
+
+        # Compute IoU
+        return intersection_area / union_area
+
 
     def xywh2xyxy(self, x):
         # Convert bounding box (x, y, w, h) to bounding box (x1, y1, x2, y2)
@@ -90,26 +275,35 @@ class Utils:
         return y
 
 
-    def draw_detections(self, image, boxes, scores, class_ids, mask_alpha=0.3):
-        det_img = image.copy()
+    def draw_detections(self, image, boxes, scores, class_ids, mask_alpha=0.3, out=None):
+        """
+        Draws the detections with their masks, boxes and captions
+        @param out: buffer of image's shape to draw into, image itself draws in place.
+                    None draws onto a copy of image
+        @return out
+        """
+        if out is None:
+            out = image.copy()
+        elif out is not image:
+            np.copyto(out, image)
 
         img_height, img_width = image.shape[:2]
         font_size = min([img_height, img_width]) * 0.0006
         text_thickness = int(min([img_height, img_width]) * 0.001)
 
-        det_img = self.draw_masks(det_img, boxes, class_ids, mask_alpha)
+        self.blend_masks(out, boxes, class_ids, mask_alpha)
 
         # Draw bounding boxes and labels of detections
         for class_id, box, score in zip(class_ids, boxes, scores):
             color = self.colors[class_id]
 
-            self.draw_box(det_img, box, color)
+            self.draw_box(out, box, color)
 
             label = self.class_names[class_id]
             caption = f'{label} {int(score * 100)}%'
-            self.draw_text(det_img, caption, box, color, font_size, text_thickness)
+            self.draw_text(out, caption, box, color, font_size, text_thickness)
 
-        return det_img
+        return out
 
 
     def draw_box(self, image: np.ndarray, box: np.ndarray, color: tuple[int, int, int] = (0, 0, 255),
@@ -121,8 +315,7 @@ class Utils:
     def draw_text(self, image: np.ndarray, text: str, box: np.ndarray, color: tuple[int, int, int] = (0, 0, 255),
                 font_size: float = 0.001, text_thickness: int = 2) -> np.ndarray:
         x1, y1, x2, y2 = box.astype(int)
-        (tw, th), _ = cv2.getTextSize(text=text, fontFace=cv2.FONT_HERSHEY_SIMPLEX,
-                                    fontScale=font_size, thickness=text_thickness)
+        tw, th = self.get_text_size(text, font_size, text_thickness)
         th = int(th * 1.2)
 
         cv2.rectangle(image, (x1, y1),
@@ -130,16 +323,63 @@ class Utils:
 
         return cv2.putText(image, text, (x1, y1), cv2.FONT_HERSHEY_SIMPLEX, font_size, (255, 255, 255), text_thickness, cv2.LINE_AA)
 
-    def draw_masks(self, image: np.ndarray, boxes: np.ndarray, classes: np.ndarray, mask_alpha: float = 0.3) -> np.ndarray:
-        mask_img = image.copy()
-
-        # Draw bounding boxes and labels of detections
-        for box, class_id in zip(boxes, classes):
-            color = self.colors[class_id]
+    def get_text_size(self, text: str, font_size: float, text_thickness: int) -> tuple[int, int]:
+        """cv2.getTextSize of text, cached since the same few captions are drawn on every frame"""
+        key = (text, font_size, text_thickness)
+        size = self.text_sizes.get(key)
+        if size is None:
+            size, _ = cv2.getTextSize(text=text, fontFace=cv2.FONT_HERSHEY_SIMPLEX,
+                                      fontScale=font_size, thickness=text_thickness)
+            self.text_sizes[key] = size
+        return size
 
+    def draw_masks(self, image: np.ndarray, boxes: np.ndarray, classes: np.ndarray, mask_alpha: float = 0.3) -> np.ndarray:
+        return self.blend_masks(image.copy(), boxes, classes, mask_alpha)
+
+    def blend_masks(self, image: np.ndarray, boxes: np.ndarray, classes: np.ndarray, mask_alpha: float = 0.3) -> np.ndarray:
+        """
+        Blends the filled boxes into image in place. Only the regions under the boxes are
+        blended, pixels outside them would come out of the blend unchanged anyway.
+        Overlapping boxes share one region, so later boxes cover earlier ones like on a
+        full-frame mask instead of being blended twice.
+        """
+        img_height, img_width = image.shape[:2]
+        for (rx1, ry1, rx2, ry2), box_ids in self.get_mask_regions(boxes, img_width, img_height):
+            region = image[ry1:ry2 + 1, rx1:rx2 + 1]
+            mask_img = region.copy()
+            for i in box_ids:
+                x1, y1, x2, y2 = boxes[i].astype(int)
+                # cv2 fills the same pixels and rounds the color the same way as on the full frame
+                cv2.rectangle(mask_img, (x1 - rx1, y1 - ry1), (x2 - rx1, y2 - ry1), self.colors[classes[i]], -1)
+            cv2.addWeighted(mask_img, mask_alpha, region, 1 - mask_alpha, 0, dst=region)
+
+        return image
+
+    def get_mask_regions(self, boxes: np.ndarray, img_width: int, img_height: int) -> list:
+        """
+        Groups the filled boxes into disjoint regions clipped to the image
+        @return list of ((x1, y1, x2, y2) inclusive region, ids of its boxes in drawing order)
+        """
+        regions = []
+        for i, box in enumerate(boxes):
             x1, y1, x2, y2 = box.astype(int)
-
-            # Draw fill rectangle in mask image
-            cv2.rectangle(mask_img, (x1, y1), (x2, y2), color, -1)
-
-        return cv2.addWeighted(mask_img, mask_alpha, image, 1 - mask_alpha, 0)
+            x1, x2 = max(min(x1, x2), 0), min(max(x1, x2), img_width - 1)
+            y1, y2 = max(min(y1, y2), 0), min(max(y1, y2), img_height - 1)
+            if x1 > x2 or y1 > y2:
+                continue
+            region, box_ids = (x1, y1, x2, y2), [i]
+
+            # Merge with every region it touches, until the merged region touches no other
+            merged = True
+            while merged:
+                merged = False
+                for other in regions:
+                    (ox1, oy1, ox2, oy2), other_ids = other
+                    if ox1 <= region[2] and region[0] <= ox2 and oy1 <= region[3] and region[1] <= oy2:
+                        regions.remove(other)
+                        region = (min(region[0], ox1), min(region[1], oy1), max(region[2], ox2), max(region[3], oy2))
+                        box_ids = sorted(other_ids + box_ids)
+                        merged = True
+                        break
+            regions.append((region, box_ids))
+        return regions